@@ -0,0 +1,49 @@
+#!/usr/local/bin/python3
+# encoding: utf-8
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+commands = {
+    'import': [sys.executable, '-c', 'import speedtest'],
+    'version': [sys.executable, os.path.join(here, 'cli.py'), '--version'],
+    'help': [sys.executable, os.path.join(here, 'cli.py'), '--help'], }
+
+def measure(command, repeat):
+    elapses = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapses.append(time.perf_counter() - start)
+    return sorted(elapses)
+
+def importtime(limit):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import speedtest'], cwd=here, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines()[1:]:
+        own, cumulative, name = line.split('|')
+        rows.append((int(cumulative), int(own.split(':')[1]), name.rstrip(), ))
+    return sorted(rows, reverse=True)[:limit]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure interpreter startup for speedtest-cli')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='Runs per command. Default %(default)s')
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list. Default %(default)s')
+    args = parser.parse_args()
+
+    baseline = measure([sys.executable, '-c', 'pass'], args.repeat)
+    print('{:<10} {:>8} {:>8} {:>8}'.format('command', 'min', 'median', 'max'))
+    for name, elapses in [('python', baseline)] + [(name, measure(command, args.repeat)) for name, command in commands.items()]:
+        print('{:<10} {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms'.format(name, elapses[0] * 1000.0, elapses[len(elapses) // 2] * 1000.0, elapses[-1] * 1000.0))
+    print()
+    print('{:>10} {:>10}  {}'.format('cumulative', 'self', 'module'))
+    for cumulative, own, name in importtime(args.top):
+        print('{:>8}us {:>8}us  {}'.format(cumulative, own, name))
+
+if __name__ == '__main__':
+    main()
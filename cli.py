@@ -2,8 +2,8 @@
 # encoding: utf-8
 
 import sys
+import time
 import argparse
-import speedtest
 import logging
 import logging.handlers
 
@@ -27,6 +27,16 @@ class FileHandler(logging.handlers.WatchedFileHandler):
 logger = logging.getLogger('speedtest-cli').getChild(__name__)
 logger.addHandler(StderrHandler())
 
+def get_version():
+    # Read from the source: importing speedtest costs several times more than --version itself
+    import re
+    import importlib.util
+    with open(importlib.util.find_spec('speedtest').origin, encoding='utf-8') as f:
+        for line in f:
+            if (m := re.match(r'__version__\s*=\s*[\'"]([^\'"]+)[\'"]', line)):
+                return m.group(1)
+    return 'unknown'
+
 class Option(object):
     def __init__(self):
         self.prog = 'speedtest-cli'
@@ -39,7 +49,12 @@ class Option(object):
         parser.add_argument('-V', '--version', action='store_true', help='Show the version number and exit')
         parser.add_argument('--no-download', action='store_false', dest='download', help='Do not perform download test')
         parser.add_argument('--no-upload', action='store_false', dest='upload', help='Do not perform upload test')
+        parser.add_argument('--no-loaded-latency', action='store_false', dest='loaded_latency', help='Do not probe latency on a separate connection while downloading and uploading')
         parser.add_argument('--single', action='store_true', help='Only use a single connection instead of multiple. This simulates a typical file transfer.')
+        parser.add_argument('--adaptive', action='store_true', help='Repeat short measurement windows until the confidence interval on throughput is narrower than --ci-width or --budget runs out, and report the estimate with its bounds')
+        parser.add_argument('--ci-width', metavar='<pct>', action='store', default=5.0, type=float, help='Target width of the 95%% confidence interval with --adaptive, in percent of the estimate. Default %(default)s')
+        parser.add_argument('--budget', metavar='<sec>', action='store', default=60.0, type=float, help='Time allowed per direction with --adaptive. Default %(default)s')
+        parser.add_argument('--auto-size', action='store_true', help='Run a short warm-up transfer and pick request sizes so each transfer lasts about 1.5 seconds at the measured speed')
         parser.add_argument('--bytes', action='store_const', const=('byte', 8), default=('bit', 1), dest='units', help='Display values in bytes instead of bits. Does not affect the image generated by --share, nor output from --json or --csv')
         parser.add_argument('--share', action='store_true', help='Generate and provide a URL to the speedtest.net share results image, not displayed with --csv')
         parser.add_argument('--simple', action='store_true', help='Suppress verbose output, only show basic information')
@@ -47,12 +62,28 @@ class Option(object):
         parser.add_argument('--json', action='store_true', help='Suppress verbose output, only show basic information in JSON format. Speeds listed in bit/s and not affected by --bytes')
         parser.add_argument('-L', '--list', action='store_true', help='Display a list of speedtest.net servers sorted by distance')
         parser.add_argument('-s', '--server', metavar='<id>', action='append', type=int, default=[], help='Specify a server ID to test against. Can be supplied multiple times')
+        parser.add_argument('--no-server-cache', action='store_false', dest='server_cache', help='Do not reuse the best server remembered from earlier runs; always probe the closest servers. The remembered server is kept in $XDG_CACHE_HOME/speedtest')
+        parser.add_argument('--concurrent', action='store_true', help='Test the servers given by --server concurrently instead of one after another, and report per-server and aggregate throughput')
         parser.add_argument('--exclude', metavar='<id>', action='append', type=int, default=[], help='Exclude a server from selection. Can be supplied multiple times')
+        parser.add_argument('--batch', metavar='<file>', action='store', help='Test every target listed in this file (server IDs or Speedtest Mini URLs, one per line, "-" for stdin) and print one JSON line per target as it completes')
+        parser.add_argument('--batch-jobs', metavar='<n>', action='store', default=4, type=int, help='Targets tested at the same time with --batch. Default %(default)s')
+        parser.add_argument('--batch-budget', metavar='<sec>', action='store', default=30.0, type=float, help='Time allowed per target with --batch, shared by its download and upload. Default %(default)s')
         parser.add_argument('--mini', metavar='<url>', action='store', help='URL of the Speedtest Mini server')
-        parser.add_argument('--source', metavar='<ipaddr>', action='store', help='Source IP address to bind to')
+        parser.add_argument('--source', metavar='<ipaddr>', action='append', default=[], help='Source IP address to bind to. When supplied multiple times, each uplink is tested in parallel and reported per interface')
         parser.add_argument('--timeout', metavar='<sec>', action='store', default=10.0, type=float, help='HTTP timeout in seconds. Default %(default)s')
         parser.add_argument('--secure', action='store_true', help='Use HTTPS instead of HTTP when communicating with speedtest.net operated servers')
         parser.add_argument('--no-pre-allocate', action='store_false', dest='pre_allocate', help='Do not pre allocate upload data. Pre allocation is enabled by default to improve upload performance. To support systems with insufficient memory, use this option to avoid a MemoryError')
+        parser.add_argument('--progress', action='store_true', help='Show live rolling throughput, elapsed time, bytes transferred and active streams on stderr while testing')
+        parser.add_argument('--samples', metavar='<file>', action='store', help='Stream every request (timestamp, direction, server, connection, size and phase timings) to this file while testing, "-" for stdout')
+        parser.add_argument('--samples-format', choices=['csv', 'jsonl'], default='csv', help='Format used by --samples. Default %(default)s')
+        parser.add_argument('--prometheus', metavar='<[addr:]port>', action='store', help='Serve live and last-run metrics for Prometheus on this address, and keep serving after the test until interrupted')
+        parser.add_argument('--protocol', choices=['http', 'tcp'], default='http', help='Transfer protocol. "tcp" speaks the speedtest.net socket protocol to the host:port in the server list, with far less per-request overhead than HTTP. Default %(default)s')
+        parser.add_argument('--engine', choices=['http.client', 'raw'], default='http.client', help='HTTP client used for the transfer and latency requests. "raw" is a minimal HTTP/1.1 client that only parses the status line, Content-Length and Connection. Default %(default)s')
+        parser.add_argument('--rcvbuf', metavar='<bytes>', action='store', type=int, help='SO_RCVBUF for the transfer connections, set before connecting. Default: left to the kernel, which autotunes it')
+        parser.add_argument('--sndbuf', metavar='<bytes>', action='store', type=int, help='SO_SNDBUF for the transfer connections, set before connecting. Default: left to the kernel, which autotunes it')
+        parser.add_argument('--no-nodelay', action='store_false', dest='nodelay', help='Leave Nagle\'s algorithm enabled (no TCP_NODELAY) on the transfer connections')
+        parser.add_argument('--zero-copy', action='store_true', help='On Linux, keep the upload payload in a memfd and send request bodies with sendfile() instead of copying them through Python')
+        parser.add_argument('--dual-stack', action='store_true', help='Measure the selected server over both IPv4 and IPv6 in the same run, one family after the other, and report both')
         parser.add_argument('-4', '--ipv4', action='store_true', help='Use IPv4')
         parser.add_argument('-6', '--ipv6', action='store_true', help='Use IPv6')
         parser.add_argument('-D', '--debug', action='store_true', help=argparse.SUPPRESS)
@@ -62,14 +93,89 @@ def main():
     logger.setLevel(logging.DEBUG)
     option = Option()
     if option.args.version:
-        print('%s %s' % (option.prog, speedtest.__version__, ))
+        print('%s %s' % (option.prog, get_version(), ))
         print('Python %s' % (sys.version.strip(), ))
         return
+    import speedtest
     if option.args.debug:
         logging.getLogger('speedtest').setLevel(logging.DEBUG)
         logger.debug(option.args)
 
     testsuite = speedtest.TestSuite(option=option)
+    exporter = None
+    if option.args.prometheus:
+        host, _, port = option.args.prometheus.rpartition(':')
+        exporter = testsuite.observe(speedtest.MetricsExporter(address=(host.strip('[]'), int(port), ))).serve()
+    progress = None
+    if option.args.progress:
+        progress = testsuite.observe(speedtest.ProgressMonitor(units=option.args.units)).start()
+    samples = None
+    if option.args.samples:
+        stream = sys.stdout if option.args.samples == '-' else open(option.args.samples, 'w', encoding='utf-8', newline='')
+        samples = testsuite.observe(speedtest.SampleExporter(stream, format=option.args.samples_format)).start()
+    try:
+        results = run(option, testsuite)
+    finally:
+        if progress:
+            progress.stop()
+        if samples:
+            samples.stop()
+            if samples.stream is not sys.stdout:
+                samples.stream.close()
+    if exporter:
+        if results:
+            exporter.update(results)
+        logger.info('Serving metrics on %s, press Ctrl-C to exit' % (option.args.prometheus, ))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            exporter.shutdown()
+
+def print_flows(option, results):
+    for flow in results.flows:
+        print('  Flow #%d: %s%s/s, %d requests, %sB%s' % (
+            flow['connection'],
+            units.Bandwidth(flow['speed']) / option.args.units[1], option.args.units[0],
+            flow['requests'],
+            units.Size(flow['size']),
+            ', rtt=%.1fms/%.1fms, cwnd=%d, retrans=%d' % (
+                flow['tcp']['rtt'] / 1000.0, flow['tcp']['rttvar'] / 1000.0, flow['tcp']['snd_cwnd'], flow['tcp']['total_retrans'], ) if 'total_retrans' in flow['tcp'] else ''))
+
+def print_loaded_latency(results, server):
+    if not results.loaded_latency.count:
+        return
+    loaded = results.loaded_latency.quantile(0.5) * 1000.0
+    print('  Loaded latency: %.1fms (p90 %.1fms), %+.1fms over idle' % (
+        loaded, results.loaded_latency.quantile(0.9) * 1000.0, loaded - server.latency, ))
+
+def print_tcp_info(results):
+    if not results.tcp.samples:
+        return
+    print('  TCP: rtt %.1fms (p90 %.1fms, var %.1fms), cwnd %d, %d retransmits over %d connections' % (
+        results.tcp.rtt.quantile(0.5) * 1000.0, results.tcp.rtt.quantile(0.9) * 1000.0, results.tcp.rttvar.quantile(0.5) * 1000.0,
+        results.tcp.cwnd.quantile(0.5), results.tcp.retransmits, results.tcp.connections, ))
+
+def print_skipped(results):
+    if results.tripped:
+        print('  Cut short: the server kept failing (%d errors), the remaining requests were not sent' % (results.errors, ))
+    elif not results.count:
+        print('  No request completed (%d errors), measurement skipped' % (results.errors, ))
+
+def read_targets(filename):
+    f = sys.stdin if filename == '-' else open(filename, encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run(option, testsuite):
+    import json
+    import speedtest
     if option.args.list:
         for server in sorted(testsuite.servers, key=lambda server: server.distance):
             supports = []
@@ -85,6 +191,50 @@ def main():
                 'support': ', '.join(supports),
                 'distance': server.distance, })
         return
+    if option.args.batch:
+        test = speedtest.BatchTest(testsuite, read_targets(option.args.batch), jobs=option.args.batch_jobs, budget=option.args.batch_budget)
+        for target, results in test:
+            if isinstance(results, Exception):
+                print(json.dumps({'target': target, 'error': str(results) or results.__class__.__name__}), flush=True)
+            else:
+                print(json.dumps(dict(results, target=target)), flush=True)
+        return
+    if len(option.args.source) > 1:
+        print('Hosted by {sponsor} ({name}) [{distance:.2f}km]: {latency:.1f}ms'.format(
+            sponsor=testsuite.server.sponsor,
+            name=testsuite.server.name,
+            distance=testsuite.server.distance,
+            latency=testsuite.server.latency))
+        test = speedtest.ConcurrentTest(map(lambda source: testsuite.server.bind(source), option.args.source))
+        for label, direction in (('Download', 'download'), ('Upload', 'upload'), ):
+            if not getattr(option.args, direction):
+                continue
+            results = getattr(test, direction)
+            for server, result in results:
+                print('%s: %s%s/s (via %s)' % (
+                    label, units.Bandwidth(result.wallclock_speed) / option.args.units[1], option.args.units[0], server.source_address, ))
+            print('%s: %s%s/s (bonded, %.1fs)' % (
+                label, units.Bandwidth(results.speed) / option.args.units[1], option.args.units[0], results.wallclock, ))
+        return
+    if option.args.server and option.args.concurrent:
+        servers = list(map(lambda id: testsuite.servers.findById(id), option.args.server))
+        for server in servers:
+            print('Hosted by {sponsor} ({name}) [{distance:.2f}km]: {latency:.1f}ms'.format(
+                sponsor=server.sponsor,
+                name=server.name,
+                distance=server.distance,
+                latency=server.latency))
+        test = speedtest.ConcurrentTest(servers)
+        for label, direction in (('Download', 'download'), ('Upload', 'upload'), ):
+            if not getattr(option.args, direction):
+                continue
+            results = getattr(test, direction)
+            for server, result in results:
+                print('%s: %s%s/s (%d) %s' % (
+                    label, units.Bandwidth(result.wallclock_speed) / option.args.units[1], option.args.units[0], server.id, server.sponsor, ))
+            print('%s: %s%s/s (aggregate, %.1fs)' % (
+                label, units.Bandwidth(results.speed) / option.args.units[1], option.args.units[0], results.wallclock, ))
+        return
     if option.args.server:
         download = speedtest.DownloadResults()
         upload = speedtest.UploadResults()
@@ -116,12 +266,56 @@ def main():
         distance=testsuite.server.distance,
         latency=testsuite.server.latency))
     
+    if option.args.dual_stack:
+        servers = []
+        for label, version in (('IPv4', 'ipv4'), ('IPv6', 'ipv6'), ):
+            server = testsuite.server.family(version)
+            if not getattr(server, 'support_' + version):
+                print('%s: not available' % (label, ))
+                continue
+            print('%s: %.1fms' % (label, server.latency, ))
+            servers.append((label, server, ))
+        # Families take turns per direction rather than sharing the link at the same time
+        for label, direction in (('Download', 'download'), ('Upload', 'upload'), ):
+            if not getattr(option.args, direction):
+                continue
+            for family, server in servers:
+                print('%s (%s): %s%s/s' % (
+                    label, family, units.Bandwidth(getattr(server, direction).speed) / option.args.units[1], option.args.units[0], ))
+        if option.args.json:
+            print(json.dumps({server.ip_version: dict(speedtest.TestSuiteResults(testsuite,
+                server.download if option.args.download else None,
+                server.upload if option.args.upload else None, server=server)) for _, server in servers}, indent=4))
+        return
+    
+    if option.args.adaptive:
+        test = speedtest.AdaptiveTest(testsuite.server, width=option.args.ci_width / 100.0, budget=option.args.budget)
+        for label, direction in (('Download', 'download'), ('Upload', 'upload'), ):
+            if not getattr(option.args, direction):
+                continue
+            estimate = getattr(test, direction)
+            print('%s: %s%s/s (95%% CI %s-%s, %d windows, %s)' % (
+                label, units.Bandwidth(estimate.speed) / option.args.units[1], option.args.units[0],
+                units.Bandwidth(estimate.lower) / option.args.units[1], units.Bandwidth(estimate.upper) / option.args.units[1],
+                estimate.windows, estimate.reason, ))
+        return speedtest.TestSuiteResults(testsuite, test.download.results if option.args.download else None, test.upload.results if option.args.upload else None)
+    
     if option.args.download:
         print('Download: %s%s/s' % (
             units.Bandwidth(testsuite.server.download.speed) / option.args.units[1], option.args.units[0], ))
+        print_skipped(testsuite.server.download)
+        print_loaded_latency(testsuite.server.download, testsuite.server)
+        print_tcp_info(testsuite.server.download)
+        if option.args.single:
+            print_flows(option, testsuite.server.download)
     if option.args.upload:
         print('Upload: %s%s/s' % (
             units.Bandwidth(testsuite.server.upload.speed) / option.args.units[1], option.args.units[0], ))
+        print_skipped(testsuite.server.upload)
+        print_loaded_latency(testsuite.server.upload, testsuite.server)
+        print_tcp_info(testsuite.server.upload)
+        if option.args.single:
+            print_flows(option, testsuite.server.upload)
 
     if option.args.simple:
         print('Ping: %fms\nDownload: %s%s/s\nUpload: %s%s/s' % (
@@ -132,6 +326,10 @@ def main():
         print(testsuite.results.csv())
     elif option.args.json:
         print(testsuite.results.json())
+    # Only the phases that were asked for; testsuite.results would run both
+    return speedtest.TestSuiteResults(testsuite,
+        testsuite.server.download if option.args.download else None,
+        testsuite.server.upload if option.args.upload else None)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -2,31 +2,37 @@
 # encoding: utf-8
 
 from functools import wraps
+import functools
+import copy
 import dataclasses
 import re
 import random
 import io
+import array
 import os
+import sys
 import os.path
 import math
+import hashlib
+import errno
 import time
 import datetime
 import ipaddress
-import csv
 import json
-import hashlib
-import platform
 import ssl
 import queue
+import collections
+import itertools
+import struct
 import threading
-import multiprocessing
 import socket
+import socketserver
+import mmap
+import selectors
 import http.client
 import urllib.request
 import urllib.parse
 import urllib.error
-import xml.dom
-import xml.dom.minidom
 import logging
 import logging.handlers
 
@@ -80,7 +86,64 @@ class FileHandler(logging.handlers.WatchedFileHandler):
 logger = logging.getLogger('speedtest').getChild(__name__)
 logger.addHandler(StderrHandler())
 
+TCP_INFO_FIELDS = (
+    ('state', 'B'), ('ca_state', 'B'), ('retransmits', 'B'), ('probes', 'B'), ('backoff', 'B'), ('options', 'B'), ('wscale', 'B'), ('flags', 'B'),
+    ('rto', 'I'), ('ato', 'I'), ('snd_mss', 'I'), ('rcv_mss', 'I'), ('unacked', 'I'), ('sacked', 'I'), ('lost', 'I'), ('retrans', 'I'), ('fackets', 'I'),
+    ('last_data_sent', 'I'), ('last_ack_sent', 'I'), ('last_data_recv', 'I'), ('last_ack_recv', 'I'),
+    ('pmtu', 'I'), ('rcv_ssthresh', 'I'), ('rtt', 'I'), ('rttvar', 'I'), ('snd_ssthresh', 'I'), ('snd_cwnd', 'I'), ('advmss', 'I'), ('reordering', 'I'),
+    ('rcv_rtt', 'I'), ('rcv_space', 'I'), ('total_retrans', 'I'),
+    ('pacing_rate', 'Q'), ('max_pacing_rate', 'Q'), ('bytes_acked', 'Q'), ('bytes_received', 'Q'),
+    ('segs_out', 'I'), ('segs_in', 'I'), ('notsent_bytes', 'I'), ('min_rtt', 'I'), ('data_segs_in', 'I'), ('data_segs_out', 'I'),
+    ('delivery_rate', 'Q'), )
+
+def tcp_info(sock):
+    """Decode Linux struct tcp_info; fields the running kernel does not provide are omitted."""
+    if not hasattr(socket, 'TCP_INFO'):
+        return {}
+    try:
+        buff = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 256)
+    except OSError:
+        return {}
+    info = {}
+    offset = 0
+    for name, fmt in TCP_INFO_FIELDS:
+        size = struct.calcsize('=' + fmt)
+        if len(buff) < offset + size:
+            break
+        info[name] = struct.unpack_from('=' + fmt, buff, offset)[0]
+        offset += size
+    return info
+
+def unsent_bytes(sock):
+    """Bytes written to sock that the peer has not acknowledged yet (Linux SIOCOUTQ); 0 where unsupported."""
+    try:
+        import fcntl
+        import termios
+        buff = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0' * 4)
+    except (ImportError, AttributeError, OSError):
+        return 0
+    return struct.unpack('i', buff)[0]
+
+connection_counter = itertools.count(1)
+
+# Approximate body sizes of the /random<N>x<N>.jpg images served by speedtest.net servers
+DOWNLOAD_SIZES = {
+    350: 245388,
+    500: 505544,
+    750: 1118012,
+    1000: 1986284,
+    1500: 4468241,
+    2000: 7907740,
+    2500: 12407926,
+    3000: 17816816,
+    3500: 24262167,
+    4000: 31625365, }
+UPLOAD_MAX_SIZE = 32*1024*1024
+
 class HttpRetrievalError(Exception): pass
+class TransferCancelled(Exception): pass
+class ProtocolError(Exception): pass
+class CircuitOpen(Exception): pass
 
 class URL(object):
     def __init__(self, url, secure=True):
@@ -116,7 +179,8 @@ class URL(object):
     def port(self):
         port_matrix = {
             'http': 80,
-            'https': 443, }
+            'https': 443,
+            'tcp': 8080, }
         return self.parse.port or port_matrix[self.scheme]
     
     @property
@@ -169,19 +233,595 @@ class URL(object):
             return
         return random.choice(self.addrinfo6)[4][0]
     
+def connect_happy_eyeballs(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None, delay=0.25, options=()):
+    # RFC 8305: race addresses of alternating families, starting the next attempt every delay seconds or as soon as one fails
+    host, port = address[:2]
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if source_address:
+        family = socket.AF_INET6 if ':' in source_address[0] else socket.AF_INET
+        infos = [info for info in infos if info[0] == family]
+    families = {}
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    candidates = [info for group in itertools.zip_longest(*families.values()) for info in group if info]
+    if not candidates:
+        raise socket.gaierror('No usable address for {}'.format(host))
+    limit = None if timeout in (None, socket._GLOBAL_DEFAULT_TIMEOUT, ) else time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    pending = {}
+    errors = []
+    winner = None
+    try:
+        next_attempt = 0.0
+        while winner is None:
+            now = time.monotonic()
+            if limit is not None and limit <= now:
+                raise socket.timeout('timed out')
+            if candidates and (not pending or next_attempt <= now):
+                family, socktype, proto, _, sockaddr = candidates.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    sock.setblocking(False)
+                    for option in options:
+                        sock.setsockopt(*option)
+                    if source_address:
+                        sock.bind(source_address)
+                    err = sock.connect_ex(sockaddr)
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, ):
+                        raise OSError(err, os.strerror(err))
+                except OSError as e:
+                    sock.close()
+                    errors.append(e)
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                pending[sock] = sockaddr
+                next_attempt = now + delay
+                continue
+            if not pending:
+                raise errors[-1]
+            waits = [next_attempt - now] if candidates else []
+            if limit is not None:
+                waits.append(limit - now)
+            for key, _ in selector.select(max(min(waits), 0.0) if waits else None):
+                sock = key.fileobj
+                selector.unregister(sock)
+                del pending[sock]
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    sock.close()
+                    errors.append(OSError(err, os.strerror(err)))
+                    continue
+                winner = sock
+                break
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+    winner.setblocking(True)
+    winner.settimeout(socket.getdefaulttimeout() if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+    return winner
+
+@functools.lru_cache(maxsize=None)
+def get_user_agent():
+    # platform.architecture() may spawn file(1); the answer cannot change within a process
+    import platform
+    return (
+        'Mozilla/5.0 '
+        '({platform}; U; {architecture}; en-us) '
+        'Python/{python_version} '
+        '(KHTML, like Gecko) '
+        'speedtest-cli/{version}').format(
+            platform=platform.platform(),
+            architecture=platform.architecture()[0],
+            python_version=platform.python_version(),
+            version=__version__)
+
+class SourceAddressHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, source_address=None):
+        super().__init__()
+        self.source_address = source_address
+        
+    def http_open(self, req):
+        return self.do_open(functools.partial(http.client.HTTPConnection, source_address=self.source_address), req)
+
+class SourceAddressHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, source_address=None):
+        super().__init__()
+        self.source_address = source_address
+        
+    def https_open(self, req):
+        return self.do_open(functools.partial(http.client.HTTPSConnection, source_address=self.source_address), req, context=self._context)
+
+class TLSSessionCache(object):
+    def __init__(self, context=None):
+        self._context = context
+        self.sessions = {}
+        self.handshakes = 0
+        self.resumed = 0
+        self.lock = threading.Lock()
+        
+    def __repr__(self):
+        return '<TLSSessionCache: sessions={},handshakes={},resumed={}>'.format(len(self.sessions), self.handshakes, self.resumed)
+    
+    @property
+    def context(self):
+        # Loading the default CA store is slow; only pay for it once HTTPS is actually used
+        with self.lock:
+            if self._context is None:
+                self._context = ssl.create_default_context()
+                self._context.set_alpn_protocols(['http/1.1'])
+            return self._context
+    
+    def __iter__(self):
+        return iter({
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+            'resumed_ratio': self.resumed_ratio}.items())
+    
+    def get(self, key):
+        return self.sessions.get(key)
+    
+    def put(self, key, session):
+        if session is None:
+            return
+        with self.lock:
+            self.sessions[key] = session
+    
+    def wrap_socket(self, sock, server_hostname, port):
+        sock = self.context.wrap_socket(sock, server_hostname=server_hostname, session=self.get((server_hostname, port, )))
+        with self.lock:
+            self.handshakes += 1
+            if sock.session_reused:
+                self.resumed += 1
+        return sock
+    
+    def remember(self, sock, server_hostname, port):
+        if isinstance(sock, ssl.SSLSocket):
+            self.put((server_hostname, port, ), sock.session)
+    
+    @property
+    def resumed_ratio(self):
+        if not self.handshakes:
+            return 0.0
+        return self.resumed / self.handshakes
+
+class ResumableHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, tls_sessions, server_hostname=None, **kwargs):
+        super().__init__(host, context=tls_sessions.context, **kwargs)
+        self.tls_sessions = tls_sessions
+        self.server_hostname = server_hostname or self.host
+        
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self.tls_sessions.wrap_socket(self.sock, self._tunnel_host or self.server_hostname, self.port)
+        
+    def close(self):
+        self.tls_sessions.remember(self.sock, self._tunnel_host or self.server_hostname, self.port)
+        super().close()
+
+class RawHTTPResponse(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.sock = conn.sock
+        buff = bytearray()
+        while (end := buff.find(b'\r\n\r\n')) < 0:
+            if http.client._MAXLINE * 8 < len(buff):
+                raise http.client.LineTooLong('header block')
+            chunk = self.sock.recv(conn.blocksize)
+            if not chunk:
+                raise http.client.RemoteDisconnected('Remote end closed connection without response')
+            buff += chunk
+        lines = bytes(buff[:end]).split(b'\r\n')
+        version, status, *reason = lines[0].split(None, 2)
+        self.version = version.decode('latin-1')
+        self.status = int(status)
+        self.reason = reason[0].decode('latin-1') if reason else ''
+        self.length = None
+        self.will_close = version == b'HTTP/1.0'
+        # Only the headers the transfer loops act on are parsed
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'content-length':
+                self.length = int(value)
+            elif name == b'connection':
+                self.will_close = value.strip().lower() == b'close'
+            elif name == b'transfer-encoding' and b'chunked' in value.lower():
+                raise http.client.HTTPException('Chunked transfer encoding is not supported')
+        if self.length is None or self.status in (204, 304, ) or self.status < 200:
+            self.length = 0 if self.status in (204, 304, ) or self.status < 200 else None
+        if self.length is None:
+            self.will_close = True
+        self.remaining = self.length
+        self.pending = bytes(buff[end + 4:])
+        self.closed = False
+        if self.remaining == 0:
+            self.finish()
+            
+    def getheader(self, name, default=None):
+        name = name.lower()
+        if name == 'content-length' and self.length is not None:
+            return str(self.length)
+        if name == 'connection':
+            return ['keep-alive', 'close'][self.will_close]
+        return default
+    
+    def finish(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.will_close:
+            self.conn.close()
+            
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self.remaining is not None:
+            view = view[:self.remaining]
+        if self.closed or not len(view):
+            self.finish()
+            return 0
+        if self.pending:
+            n = min(len(view), len(self.pending))
+            view[:n] = self.pending[:n]
+            self.pending = self.pending[n:]
+        else:
+            n = self.sock.recv_into(view)
+            if not n:
+                # Like http.client, a body cut short just ends; the caller compares against Content-Length
+                self.will_close = True
+                self.finish()
+                return 0
+        if self.remaining is not None:
+            self.remaining -= n
+            if not self.remaining:
+                self.finish()
+        return n
+    
+    def read(self, amt=None):
+        if amt is None and self.remaining is None:
+            chunks = []
+            buff = bytearray(self.conn.blocksize)
+            while (n := self.readinto(buff)):
+                chunks.append(bytes(buff[:n]))
+            return b''.join(chunks)
+        buff = bytearray(self.remaining if amt is None else min(amt, self.remaining if self.remaining is not None else amt))
+        view = memoryview(buff)
+        received = 0
+        while received < len(buff) and (n := self.readinto(view[received:])):
+            received += n
+        if self.remaining == 0:
+            self.finish()
+        return buff[:received] if received < len(buff) else buff
+    
+    def close(self):
+        self.closed = True
+
+class RawHTTPConnection(object):
+    blocksize = 64*1024
+    
+    def __init__(self, host, port=None, source_address=None, secure=False, tls_sessions=None, server_hostname=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, create_connection=socket.create_connection):
+        parts = urllib.parse.urlsplit('//' + host)
+        self.host = parts.hostname
+        self.port = port or parts.port or (80, 443, )[bool(secure)]
+        self.source_address = source_address
+        self.timeout = timeout
+        self.create_connection = create_connection
+        self.secure = secure
+        self.tls_sessions = tls_sessions
+        self.server_hostname = server_hostname or self.host
+        self.sock = None
+        self.buffer = []
+        self.response = None
+        
+    def __repr__(self):
+        return '<RawHTTPConnection: host={},port={},secure={}>'.format(self.host, self.port, self.secure)
+    
+    def connect(self):
+        self.sock = self.create_connection((self.host, self.port, ), self.timeout, source_address=self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.secure:
+            self.sock = self.tls_sessions.wrap_socket(self.sock, self.server_hostname, self.port)
+            
+    def close(self):
+        if self.sock is None:
+            return
+        if self.secure:
+            self.tls_sessions.remember(self.sock, self.server_hostname, self.port)
+        self.sock.close()
+        self.sock = None
+        
+    def putrequest(self, method, url, skip_host=False, skip_accept_encoding=False):
+        if self.response is not None and not self.response.closed:
+            raise http.client.ResponseNotReady()
+        self.buffer = ['%s %s HTTP/1.1' % (method, url, )]
+        
+    def putheader(self, header, *values):
+        self.buffer.append('%s: %s' % (header, ', '.join(map(str, values)), ))
+        
+    def endheaders(self, message_body=None):
+        head = ('\r\n'.join(self.buffer) + '\r\n\r\n').encode('latin-1')
+        self.buffer = []
+        self.send_request(head, message_body)
+        
+    def send_request(self, head, body=None):
+        if self.response is not None and not self.response.closed:
+            raise http.client.ResponseNotReady()
+        if self.sock is None:
+            self.connect()
+        self.send(head, body)
+        
+    def request(self, method, url, body=None, headers={}):
+        self.putrequest(method, url)
+        for name, value in headers.items():
+            self.putheader(name, value)
+        self.endheaders(body)
+        
+    def send(self, head, body=None):
+        if body is None:
+            self.sock.sendall(head)
+            return
+        if isinstance(body, (bytes, bytearray, memoryview, )):
+            block, body = body, None
+        else:
+            block = body.read(self.blocksize)
+        if isinstance(self.sock, ssl.SSLSocket):
+            self.sock.sendall(head + block)
+        else:
+            # Header block and first body block go out in one sendmsg()
+            sent = self.sock.sendmsg([head, block])
+            if sent < len(head) + len(block):
+                self.sock.sendall((head + bytes(block))[sent:])
+        while body is not None and (block := body.read(self.blocksize)):
+            self.sock.sendall(block)
+            
+    def getresponse(self):
+        self.response = RawHTTPResponse(self)
+        return self.response
+
+class HTTPConnectionFactory(object):
+    def __init__(self, version='both', source_address=None, tls_sessions=None, engine='http.client', timeout=socket._GLOBAL_DEFAULT_TIMEOUT, rcvbuf=None, sndbuf=None, nodelay=True):
+        self.version = version
+        self.source_address = source_address
+        self.tls_sessions = tls_sessions or TLSSessionCache()
+        self.engine = engine
+        # Applies to connect, the TLS handshake and every read, so a silent peer fails instead of hanging a worker
+        self.timeout = timeout
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.nodelay = nodelay
+        
+    def __repr__(self):
+        return '<HTTPConnectionFactory: version={},source_address={},tls_sessions={!r},engine={},timeout={},rcvbuf={},sndbuf={},nodelay={}>'.format(self.version, self.source_address, self.tls_sessions, self.engine, self.timeout, self.rcvbuf, self.sndbuf, self.nodelay)
+    
+    @property
+    def source(self):
+        if not self.source_address:
+            return None
+        return (self.source_address, 0, )
+    
+    @property
+    def options(self):
+        options = []
+        if self.rcvbuf:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf, ))
+        if self.sndbuf:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf, ))
+        return tuple(options)
+    
+    @property
+    def create_connection(self):
+        # With a single family the address is already pinned by netloc(); buffer sizes have to be set before
+        # connect to count towards the window scale offered in the SYN
+        if self.version == 'both' or self.options:
+            return functools.partial(connect_happy_eyeballs, options=self.options)
+        return socket.create_connection
+    
+    def tune(self, sock):
+        # Every engine turns Nagle off on connect, so this only matters when asked to keep it
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+    
+    def netloc(self, url):
+        if self.version == 'ipv4':
+            return '%s:%d' % (url.resolve4, url.port)
+        elif self.version == 'ipv6':
+            return '[%s]:%d' % (url.resolve6, url.port)
+        return url.netloc
+    
+    def __call__(self, url):
+        if self.engine == 'raw':
+            return RawHTTPConnection(self.netloc(url), secure=url.scheme == 'https', tls_sessions=self.tls_sessions, server_hostname=url.hostname, source_address=self.source, timeout=self.timeout, create_connection=self.create_connection)
+        if url.scheme == 'https':
+            conn = ResumableHTTPSConnection(self.netloc(url), self.tls_sessions, server_hostname=url.hostname, source_address=self.source, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.netloc(url), source_address=self.source, timeout=self.timeout)
+        conn._create_connection = self.create_connection
+        return conn
+
+class TCPConnection(object):
+    blocksize = 256*1024
+    
+    def __init__(self, host, source_address=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, create_connection=socket.create_connection):
+        parts = urllib.parse.urlsplit('//' + host)
+        self.host = parts.hostname
+        self.port = parts.port or 8080
+        self.source_address = source_address
+        self.timeout = timeout
+        self.create_connection = create_connection
+        self.sock = None
+        self.pending = b''
+        self.hello = None
+        
+    def __repr__(self):
+        return '<TCPConnection: host={},port={},hello="{}">'.format(self.host, self.port, self.hello)
+    
+    @property
+    @memoized
+    def buffer(self):
+        return memoryview(bytearray(self.blocksize))
+    
+    @property
+    @memoized
+    def block(self):
+        # Filler without newlines except the last byte, so the final slice of any upload ends the command
+        chars = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        return memoryview((chars * (self.blocksize // len(chars) + 1))[:self.blocksize - 1] + b'\n')
+    
+    def connect(self):
+        self.sock = self.create_connection((self.host, self.port, ), self.timeout, source_address=self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.hello = self.command('HI', 'HELLO')
+        
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendall(b'QUIT\n')
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+        self.pending = b''
+        
+    def readline(self):
+        while b'\n' not in self.pending:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ProtocolError('Connection closed by server')
+            self.pending += chunk
+        line, _, self.pending = self.pending.partition(b'\n')
+        return line.decode('ascii', 'replace').strip()
+    
+    def command(self, line, expect):
+        self.sock.sendall(line.encode('ascii') + b'\n')
+        response = self.readline()
+        if not response.startswith(expect):
+            raise ProtocolError('{} => {}'.format(line, response))
+        return response
+    
+    def ping(self):
+        start = time.perf_counter()
+        self.command('PING %d' % (time.time() * 1000.0, ), 'PONG')
+        return time.perf_counter() - start
+    
+    def download(self, size, terminated=None, observers=None):
+        # The reply is exactly size bytes, "DOWNLOAD " and filler up to a trailing newline
+        self.sock.sendall(b'DOWNLOAD %d\n' % (size, ))
+        received, first = 0, None
+        while received < size and not (terminated and terminated.is_set()):
+            n = self.sock.recv_into(self.buffer, min(self.blocksize, size - received))
+            if not n:
+                raise ProtocolError('Connection closed by server')
+            if first is None:
+                first = time.time()
+            received += n
+            if observers:
+                observers.notify('chunk', 'download', n)
+        return received, first
+    
+    def upload(self, size, terminated=None, observers=None):
+        # size counts the command line too; the body ends with the block's trailing newline
+        head = b'UPLOAD %d 0\n' % (size, )
+        self.sock.sendall(head)
+        sent, remaining = len(head), max(size - len(head), 1)
+        while remaining and not (terminated and terminated.is_set()):
+            n = min(self.blocksize - 1, remaining)
+            self.sock.sendall(self.block[:n] if n < remaining else self.block[self.blocksize - n:])
+            sent += n
+            remaining -= n
+            if observers:
+                observers.notify('chunk', 'upload', n)
+        if remaining:
+            return sent, None
+        response = self.readline()
+        if not response.startswith('OK'):
+            raise ProtocolError(response)
+        return sent, time.time()
+
+class TCPConnectionFactory(HTTPConnectionFactory):
+    def __repr__(self):
+        return '<TCPConnectionFactory: version={},source_address={},timeout={},rcvbuf={},sndbuf={},nodelay={}>'.format(self.version, self.source_address, self.timeout, self.rcvbuf, self.sndbuf, self.nodelay)
+    
+    def __call__(self, url):
+        return TCPConnection(self.netloc(url), source_address=self.source, timeout=self.timeout, create_connection=self.create_connection)
+
+class TCPProtocolHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while (line := self.rfile.readline()):
+            words = line.split()
+            if not words:
+                continue
+            command = words[0].upper()
+            if command == b'HI':
+                self.wfile.write(b'HELLO 2.9 (2.9.0) speedtest-cli/%s\n' % (__version__.encode('ascii'), ))
+            elif command == b'PING':
+                self.wfile.write(b'PONG %d\n' % (time.time() * 1000.0, ))
+            elif command == b'GETIP':
+                self.wfile.write(b'YOURIP %s\n' % (self.client_address[0].encode('ascii'), ))
+            elif command == b'DOWNLOAD' and 1 < len(words):
+                self.download(int(words[1]))
+            elif command == b'UPLOAD' and 1 < len(words):
+                self.upload(int(words[1]), len(line))
+            elif command == b'QUIT':
+                break
+            else:
+                self.wfile.write(b'ERROR\n')
+                
+    def download(self, size):
+        block = self.server.block
+        remaining = size
+        self.wfile.write(b'DOWNLOAD '[:remaining])
+        remaining -= min(remaining, len(b'DOWNLOAD '))
+        while remaining:
+            n = min(len(block), remaining)
+            self.wfile.write(block[:n] if n < remaining else block[len(block) - n:])
+            remaining -= n
+            
+    def upload(self, size, received):
+        start = time.time()
+        buff = memoryview(bytearray(len(self.server.block)))
+        remaining = size - received
+        while 0 < remaining and (n := self.rfile.readinto(buff[:remaining])):
+            remaining -= n
+        self.wfile.write(b'OK %d %d\n' % (size, (time.time() - start) * 1000.0, ))
+
+class TCPProtocolServer(socketserver.ThreadingTCPServer):
+    # Local stand-in for the speedtest.net TCP protocol, for testing the TCP engine offline
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, TCPProtocolHandler)
+        self.block = TCPConnection('').block
+        
+    @property
+    def host(self):
+        return '%s:%d' % self.server_address[:2]
+    
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-transfer whenever a phase is cut short
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+    
+    def serve(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
 class HttpClient(object):
+    def __init__(self, source_address=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.source_address = source_address
+        self.timeout = timeout
+        
+    @property
+    @memoized
+    def opener(self):
+        source = (self.source_address, 0, ) if self.source_address else None
+        return urllib.request.build_opener(
+            SourceAddressHTTPHandler(source_address=source),
+            SourceAddressHTTPSHandler(source_address=source))
+    
     @property
     def user_agent(self):
-        return (
-            'Mozilla/5.0 '
-            '({platform}; U; {architecture}; en-us) '
-            'Python/{python_version} '
-            '(KHTML, like Gecko) '
-            'speedtest-cli/{version}').format(
-                platform=platform.platform(),
-                architecture=platform.architecture()[0],
-                python_version=platform.python_version(),
-                version=__version__)
+        return get_user_agent()
         #return 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0'
     
     def get(self, url, params={}, headers={}):
@@ -191,7 +831,7 @@ class HttpClient(object):
                 'User-Agent': self.user_agent,
                 'Cache-Control': 'no-cache', }, headers))
         logger.debug(request.full_url)
-        with urllib.request.urlopen(request) as f:
+        with self.opener.open(request, timeout=self.timeout) as f:
             return f.read().decode(f.headers.get_content_charset('utf-8'))
 
     def post(self, url, params={}, headers={}):
@@ -204,7 +844,7 @@ class HttpClient(object):
                 'Cache-Control': 'no-cache', }, headers),
             data=data)
         logger.debug('{} {} {}'.format(request.full_url, request.header_items(), request.data))
-        with urllib.request.urlopen(request) as f:
+        with self.opener.open(request, timeout=self.timeout) as f:
             return f.read().decode(f.headers.get_content_charset('utf-8'))
 
 class Point(object):
@@ -288,8 +928,9 @@ class Client(object):
             'isp': dict(self.isp)}.items())
 
 class Config(object):
-    def __init__(self):
-        http = HttpClient()
+    def __init__(self, source_address=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        http = HttpClient(source_address=source_address, timeout=timeout)
+        import xml.dom.minidom
         root = xml.dom.minidom.parseString(http.get('https://www.speedtest.net/speedtest-config.php'))
         settings = {
             'licensekey': root.getElementsByTagName('licensekey')[0].firstChild.data,
@@ -343,52 +984,324 @@ class Config(object):
                 'sizes': upload_sizes,
                 'counts': upload_count,
                 'threads': settings['upload']['threads'],
-                'length': settings['upload']['testlength']},
+                'length': settings['upload']['testlength'],
+                'initialtest': settings['upload']['initialtest'],
+                'mintestsize': settings['upload']['mintestsize']},
             'download': {
                 'sizes': [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000],
                 'counts': settings['download']['threadsperurl'],
                 'threads': settings['server-config']['threadcount'] * 2,
-                'length': settings['download']['testlength']},
+                'length': settings['download']['testlength'],
+                'initialtest': settings['download']['initialtest'],
+                'mintestsize': settings['download']['mintestsize']},
             'upload_max': upload_count * upload_sizes_count}
         logger.debug('{!r}'.format(self.params))
 
-class Results(object):
+class RunningStats(object):
+    __slots__ = ('count', 'mean', 'm2', 'minimum', 'maximum', )
+    
     def __init__(self):
-        self.results = []
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        
+    def __repr__(self):
+        return '<RunningStats: count={},mean={:.3f},stdev={:.3f}>'.format(self.count, self.mean, self.stdev)
+    
+    def __iter__(self):
+        return iter({
+            'count': self.count,
+            'mean': self.mean,
+            'stdev': self.stdev,
+            'min': self.minimum if self.count else 0.0,
+            'max': self.maximum if self.count else 0.0}.items())
+    
+    def append(self, value):
+        # Welford's online algorithm
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        
+    def merge(self, other):
+        # Chan's parallel algorithm
+        if not other.count:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        return self
+    
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+    
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+def student_t(confidence, df):
+    # df=1 and df=2 have closed forms; above that a Cornish-Fisher expansion around the normal quantile is within 0.05
+    if df == 1:
+        return math.tan(math.pi * confidence / 2.0)
+    if df == 2:
+        return confidence * math.sqrt(2.0 / (1.0 - confidence**2))
+    import statistics
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.0)
+    return (z
+        + (z**3 + z) / (4 * df)
+        + (5*z**5 + 16*z**3 + 3*z) / (96 * df**2)
+        + (3*z**7 + 19*z**5 + 17*z**3 - 15*z) / (384 * df**3)
+        + (79*z**9 + 776*z**7 + 1482*z**5 - 1920*z**3 - 945*z) / (92160 * df**4))
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with logarithmic buckets (relative error bounded by accuracy)."""
+    __slots__ = ('accuracy', 'gamma', 'bins', 'zeros', 'count', 'total', 'maxbins', )
+    
+    def __init__(self, accuracy=0.01, maxbins=2048):
+        self.accuracy = accuracy
+        self.gamma = math.log((1.0 + accuracy) / (1.0 - accuracy))
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.maxbins = maxbins
+        
+    def __repr__(self):
+        return '<QuantileSketch: count={},bins={}>'.format(self.count, len(self.bins))
+    
+    def key(self, value):
+        return int(math.ceil(math.log(value) / self.gamma))
+    
+    def value(self, key):
+        return 2.0 * math.exp(key * self.gamma) / (1.0 + math.exp(self.gamma))
+    
+    def append(self, value, count=1):
+        self.count += count
+        self.total += value * count
+        if value <= 0.0:
+            self.zeros += count
+            return
+        key = self.key(value)
+        self.bins[key] = self.bins.get(key, 0) + count
+        if self.maxbins < len(self.bins):
+            self.collapse()
+            
+    def collapse(self):
+        keys = sorted(self.bins)
+        lowest = keys[:len(keys) - self.maxbins + 1]
+        self.bins[lowest[-1]] += sum(self.bins.pop(key) for key in lowest[:-1])
+        
+    def merge(self, other):
+        if self.accuracy != other.accuracy:
+            raise ValueError('Incompatible sketch accuracy')
+        self.count += other.count
+        self.total += other.total
+        self.zeros += other.zeros
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        while self.maxbins < len(self.bins):
+            self.collapse()
+        return self
+    
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return self.value(key)
+        return self.value(max(self.bins))
+    
+    def rank(self, value):
+        if value < 0.0:
+            return 0
+        return self.zeros + sum(count for key, count in self.bins.items() if self.value(key) <= value)
+
+class TCPInfoStats(object):
+    """Aggregate of TCP_INFO samples, taken periodically during a phase and once as each connection closes."""
+    __slots__ = ('rtt', 'rttvar', 'cwnd', 'delivery_rate', 'samples', 'connections', 'retransmits', 'segments', )
+    
+    def __init__(self):
+        self.rtt = QuantileSketch()
+        self.rttvar = QuantileSketch()
+        self.cwnd = QuantileSketch()
+        self.delivery_rate = QuantileSketch()
+        self.samples = 0
+        self.connections = 0
+        self.retransmits = 0
+        self.segments = 0
+        
+    def __repr__(self):
+        return '<TCPInfoStats: samples={},connections={},retransmits={}>'.format(self.samples, self.connections, self.retransmits)
+    
+    def __iter__(self):
+        return iter({
+            'samples': self.samples,
+            'connections': self.connections,
+            'retransmits': self.retransmits,
+            'retransmit_ratio': self.retransmit_ratio,
+            'rtt': {'p50': self.rtt.quantile(0.5) * 1000.0, 'p90': self.rtt.quantile(0.9) * 1000.0, },
+            'rttvar': {'p50': self.rttvar.quantile(0.5) * 1000.0, },
+            'cwnd': {'p50': self.cwnd.quantile(0.5), 'p90': self.cwnd.quantile(0.9), },
+            'delivery_rate': {'p50': self.delivery_rate.quantile(0.5), 'p90': self.delivery_rate.quantile(0.9), }}.items())
+    
+    def append(self, info):
+        # rtt and rttvar are reported in microseconds, delivery_rate in bytes per second
+        if 'snd_cwnd' not in info:
+            return
+        self.samples += 1
+        self.rtt.append(info['rtt'] / 1000000.0)
+        self.rttvar.append(info['rttvar'] / 1000000.0)
+        self.cwnd.append(info['snd_cwnd'])
+        if 'delivery_rate' in info:
+            self.delivery_rate.append(info['delivery_rate'] * 8)
+            
+    def complete(self, info):
+        if 'snd_cwnd' not in info:
+            return
+        self.append(info)
+        self.connections += 1
+        self.retransmits += info.get('total_retrans', 0)
+        self.segments += info.get('data_segs_out', 0)
+        
+    def merge(self, other):
+        for name in ('rtt', 'rttvar', 'cwnd', 'delivery_rate', ):
+            getattr(self, name).merge(getattr(other, name))
+        self.samples += other.samples
+        self.connections += other.connections
+        self.retransmits += other.retransmits
+        self.segments += other.segments
+        return self
+    
+    @property
+    def retransmit_ratio(self):
+        if not self.segments:
+            return None
+        return self.retransmits / self.segments
+
+class Results(object):
+    __slots__ = ('sizes', 'elapses', 'capacity', 'cursor', 'stats', 'sketch', 'phases', 'loaded_latency', 'tcp', 'histgrams', 'total_size', 'total_elapsed', 'errors', 'partials', 'tripped', 'flows', 'start', 'finish', )
+    phase_names = ('connect', 'ttfb', 'elapsed', )
+    
+    def __init__(self, capacity=1024):
+        # Samples are kept in a bounded ring; statistics cover every sample.
+        self.sizes = array.array('d')
+        self.elapses = array.array('d')
+        self.capacity = capacity
+        self.cursor = 0
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch()
+        self.phases = {name: QuantileSketch() for name in self.phase_names}
+        self.loaded_latency = QuantileSketch()
+        self.tcp = TCPInfoStats()
         self.histgrams = {}
         self.total_size = 0
         self.total_elapsed = 0.0
+        self.errors = 0
+        self.partials = 0
+        self.tripped = False
+        self.flows = []
+        self.start = None
+        self.finish = None
 
     def __add__(self, other):
         if not isinstance(other, Results):
             raise TypeError()
-        results = Results()
-        for result in self.results + other.results:
-            results.append(result)
+        results = self.__class__(capacity=self.capacity)
+        results.merge(self)
+        results.merge(other)
         return results
     
     def __iadd__(self, other):
         if not isinstance(other, Results):
             raise TypeError()
+        return self.merge(other)
+    
+    def merge(self, other):
         for result in other.results:
-            self.append(result)
+            self.store(result['size'], result['elapsed'])
+        for size, (count, elapsed) in other.histgrams.items():
+            histgram = self.histgrams.setdefault(size, [0, 0.0])
+            histgram[0] += count
+            histgram[1] += elapsed
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+        for name, sketch in other.phases.items():
+            self.phases[name].merge(sketch)
+        self.loaded_latency.merge(other.loaded_latency)
+        self.tcp.merge(other.tcp)
+        self.total_size += other.total_size
+        self.total_elapsed += other.total_elapsed
+        self.errors += other.errors
+        self.partials += other.partials
+        self.tripped |= other.tripped
+        self.flows.extend(other.flows)
+        self.start = min(filter(None, [self.start, other.start]), default=None)
+        self.finish = max(filter(None, [self.finish, other.finish]), default=None)
         return self
+    
+    def store(self, size, elapsed):
+        if self.cursor < self.capacity:
+            self.sizes.append(size)
+            self.elapses.append(elapsed)
+        else:
+            self.sizes[self.cursor % self.capacity] = size
+            self.elapses[self.cursor % self.capacity] = elapsed
+        self.cursor += 1
         
     def append(self, result):
         if result['elapsed'] < 0:
+            self.errors += 1
             return
-        if result['size'] not in self.histgrams:
-            self.histgrams[result['size']] = []
-        self.histgrams[result['size']].append(result['elapsed'])
-        self.total_size += result['size']
-        self.total_elapsed += result['elapsed']
-        self.results.append(result)
+        size, elapsed = result['size'], result['elapsed']
+        # Partial transfers have arbitrary sizes, so they stay out of the per-size histogram
+        if result.get('partial'):
+            self.partials += 1
+        else:
+            histgram = self.histgrams.setdefault(size, [0, 0.0])
+            histgram[0] += 1
+            histgram[1] += elapsed
+        if 0 < elapsed:
+            speed = size * 8 / elapsed
+            self.stats.append(speed)
+            self.sketch.append(speed)
+        for name in self.phase_names:
+            if name in result:
+                self.phases[name].append(result[name])
+        self.total_size += size
+        self.total_elapsed += elapsed
+        self.store(size, elapsed)
         
+    @property
+    def count(self):
+        return sum(map(lambda _: _[0], self.histgrams.values())) + self.partials
+    
+    @property
+    def results(self):
+        offset = self.cursor % self.capacity if self.capacity < self.cursor else 0
+        indexes = map(lambda i: (offset + i) % len(self.sizes), range(len(self.sizes)))
+        return [{'size': int(self.sizes[i]), 'elapsed': self.elapses[i], } for i in indexes]
+    
     @property
     def histgram(self):
         results = {}
-        for size, elapsed in self.histgrams.items():
-            results[size] = sum(elapsed) / len(elapsed)
+        for size, (count, elapsed) in self.histgrams.items():
+            results[size] = elapsed / count
         return results
     
     @property
@@ -397,13 +1310,63 @@ class Results(object):
     
     @property
     def speed(self):
+        # A phase cut short before any request finished (e.g. by the circuit breaker) has no elapsed time
+        if not self.total_elapsed:
+            return 0.0
         return self.total_bits / self.total_elapsed
+    
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+    
+    @property
+    def wallclock(self):
+        if self.start is None or self.finish is None:
+            return 0.0
+        return self.finish - self.start
+    
+    @property
+    def wallclock_speed(self):
+        if not self.wallclock:
+            return 0.0
+        return self.total_bits / self.wallclock
 
 class UploadResults(Results):
-    pass
+    __slots__ = ()
 
 class DownloadResults(Results):
-    pass
+    __slots__ = ()
+
+class ConcurrentResults(object):
+    def __init__(self):
+        self.results = []
+        self.start = None
+        self.finish = None
+        
+    def __iter__(self):
+        return iter(self.results)
+    
+    def append(self, server, results):
+        self.results.append((server, results, ))
+        
+    @property
+    def total_size(self):
+        return sum(map(lambda _: _[1].total_size, self.results))
+    
+    @property
+    def total_bits(self):
+        return self.total_size * 8
+    
+    @property
+    def wallclock(self):
+        if self.start is None or self.finish is None:
+            return 0.0
+        return self.finish - self.start
+    
+    @property
+    def speed(self):
+        if not self.wallclock:
+            return 0.0
+        return self.total_bits / self.wallclock
 
 class SpeedtestNetResult(object):
     def __init__(self, id, hash, rating, timestamp):
@@ -433,10 +1396,11 @@ class SpeedtestNetResult(object):
         return 'http://www.speedtest.net/result/%s.png' % (self.id, )
 
 class TestSuiteResults:
-    def __init__(self, testsuite, download, upload):
+    def __init__(self, testsuite, download, upload, server=None):
         self.testsuite = testsuite
         self.download = download
         self.upload = upload
+        self._server = server
         self._timestamp = datetime.datetime.now(datetime.timezone.utc)
 
     @property
@@ -445,14 +1409,42 @@ class TestSuiteResults:
     
     @property
     def server(self):
-        return self.testsuite.server
+        return self._server or self.testsuite.server
     
     @property
     def client(self):
         return self.testsuite.client
     
+    @property
+    def tls(self):
+        return self.testsuite.tls_sessions
+    
+    @property
+    def directions(self):
+        # download or upload is None when that direction was not run at all; it is then left out of the output
+        return [(direction, results, ) for direction, results in (('download', self.download), ('upload', self.upload), ) if results is not None]
+    
+    @property
+    def latency(self):
+        def summary(sketch):
+            return {
+                'count': sketch.count,
+                'p50': sketch.quantile(0.5) * 1000.0,
+                'p90': sketch.quantile(0.9) * 1000.0,
+                'p99': sketch.quantile(0.99) * 1000.0}
+        # The idle probes time connect plus request; halve them as Server.latency does to compare with the keep-alive probes
+        idle = QuantileSketch()
+        for latency in self.server.latencies:
+            if latency < 3600.0:
+                idle.append(latency / 2)
+        value = {'idle': summary(idle)}
+        for direction, results in self.directions:
+            value[direction] = summary(results.loaded_latency)
+            value[direction]['bufferbloat'] = (results.loaded_latency.quantile(0.5) - idle.quantile(0.5)) * 1000.0 if results.loaded_latency.count and idle.count else None
+        return value
+    
     def post(self):
-        client = HttpClient()
+        client = HttpClient(source_address=self.testsuite.source_address, timeout=self.testsuite.option.args.timeout)
         #response = client.post('https://www.speedtest.net/api/api.php',
         response = client.post('https://tayhoon.sakura.ne.jp/speedtest/api/api.php',
             headers={
@@ -488,6 +1480,7 @@ class TestSuiteResults:
         return SpeedtestNetResult.factory(self.post())
     
     def csv(self):
+        import csv
         fieldnames = ['Server ID', 'Sponsor', 'Server Name', 'Timestamp', 'Distance', 'Ping', 'Download', 'Upload', 'Share', 'IP Address']
         buff = io.StringIO(newline='')
         f = csv.DictWriter(buff, fieldnames=fieldnames)
@@ -499,24 +1492,67 @@ class TestSuiteResults:
             'Timestamp': self.timestamp,
             'Distance': self.server.distance,
             'Ping': self.server.latency,
-            'Download': self.download.speed,
-            'Upload': self.upload.speed,
+            'Download': self.download.speed if self.download is not None else '',
+            'Upload': self.upload.speed if self.upload is not None else '',
             'Share': '', # self.speedtestnet.image
             'IP Address': self.client.ipaddr
                 })
         return buff.getvalue()
     
-    def json(self):
-        return json.dumps({
-            'download': self.download.speed,
-            'upload': self.upload.speed,
+    def __iter__(self):
+        # A direction that ran but produced no samples is reported as null
+        value = {direction: results.speed if results.count else None for direction, results in self.directions}
+        value.update({
             'ping': self.server.latency,
             'server': dict(self.server),
-            'timestamp': self.timestamp,
-            'bytes_sent': self.upload.total_size,
-            'bytes_received': self.download.total_size,
+            'timestamp': self.timestamp, })
+        if self.upload is not None:
+            value['bytes_sent'] = self.upload.total_size
+        if self.download is not None:
+            value['bytes_received'] = self.download.total_size
+        value.update({
             'share': '', # self.speedtestnet.image
-            'client': dict(self.client)}, indent=4)
+            'client': dict(self.client),
+            'tls': dict(self.tls),
+            'latency': self.latency,
+            'tcp': {direction: dict(results.tcp) for direction, results in self.directions},
+            'cut_short': {direction: results.tripped for direction, results in self.directions},
+            'flows': {direction: results.flows for direction, results in self.directions}, })
+        return iter(value.items())
+    
+    def json(self, indent=4):
+        return json.dumps(dict(self), indent=indent)
+
+class Observer(object):
+    def connection_open(self, direction, conn):
+        pass
+    
+    def request_start(self, direction, url, size):
+        pass
+    
+    def first_byte(self, direction, elapsed):
+        pass
+    
+    def chunk(self, direction, size):
+        pass
+    
+    def request_complete(self, direction, result):
+        pass
+    
+    def error(self, direction, e):
+        pass
+    
+    def phase_end(self, direction, results):
+        pass
+
+class Observers(list):
+    # Callers test truthiness before notify() so an empty list costs nothing on the hot path
+    def notify(self, event, *args):
+        for observer in self:
+            try:
+                getattr(observer, event)(*args)
+            except Exception as e:
+                logger.error(e)
 
 class HTTPUploadData(io.BytesIO):
     def __init__(self, size):
@@ -622,162 +1658,486 @@ class HTTPUploadData0(object):
             self.curr = self._size
         return result
 
-class HTTPCancelableUploadData(HTTPUploadData):
-    def __init__(self, size, terminated):
-        super().__init__(size)
-        #self.terminated = terminated
+class ZeroCopyPayload(object):
+    def __init__(self, size):
+        prefix = b'content1='
+        chars = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ' * 1024
+        self.size = size
+        self.fd = os.memfd_create('speedtest-upload', os.MFD_CLOEXEC)
+        os.ftruncate(self.fd, max(size, 1))
+        self.map = mmap.mmap(self.fd, max(size, 1))
+        self.map.write(prefix[:size])
+        while self.map.tell() < size:
+            self.map.write(chars[:size - self.map.tell()])
+        self.view = memoryview(self.map)
         
-    def read(self, size):
-        result = b''
-        chunksize = 8*1024
-        while True: # not self.terminated.is_set():
-            data = super().read(size if size < chunksize else chunksize)
-            result += data
-            if len(data) < chunksize:
-                break
-            size -= len(data)
-        return result
+    def __repr__(self):
+        return '<ZeroCopyPayload: fd={},size={}>'.format(self.fd, self.size)
+    
+    @classmethod
+    def supported(cls):
+        return hasattr(os, 'memfd_create') and hasattr(os, 'sendfile')
+    
+    def close(self):
+        self.view.release()
+        self.map.close()
+        os.close(self.fd)
+
+class HTTPZeroCopyUploadData(object):
+    def __init__(self, payload, size):
+        if payload.size < size:
+            raise ValueError('Payload is smaller than request size')
+        self.payload = payload
+        self._size = size
+        
+    @property
+    def size(self):
+        return self._size
+    
+    @property
+    def mime_type(self):
+        return 'application/x-www-form-urlencoded'
+    
+    def sendfile(self, sock, offset=0, count=None):
+        finish = self._size if count is None else min(self._size, offset + count)
+        if isinstance(sock, ssl.SSLSocket):
+            # TLS has to encrypt in user space; send straight from the shared mapping
+            sock.sendall(self.payload.view[offset:finish])
+            return finish - offset
+        # Explicit offsets keep concurrent senders of the shared memfd independent
+        start = offset
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_WRITE)
+            while offset < finish:
+                if not selector.select(sock.gettimeout()):
+                    raise socket.timeout('timed out')
+                try:
+                    sent = os.sendfile(sock.fileno(), self.payload.fd, offset, finish - offset)
+                except BlockingIOError:
+                    continue
+                if not sent:
+                    raise BrokenPipeError()
+                offset += sent
+        return offset - start
+
+class HTTPCancelableUploadData(object):
+    chunksize = 256*1024
+    
+    def __init__(self, data, terminated, observers=None):
+        self.data = data
+        self.terminated = terminated
+        self.observers = observers or Observers()
+        self.sent = 0
+        
+    @property
+    def size(self):
+        return self.data.size
+    
+    @property
+    def mime_type(self):
+        return self.data.mime_type
+    
+    @property
+    def zero_copy(self):
+        return hasattr(self.data, 'sendfile')
+    
+    def read(self, size=-1):
+        if self.terminated.is_set():
+            raise TransferCancelled()
+        data = self.data.read(size if 0 <= size < self.chunksize else self.chunksize)
+        # http.client sends each block before asking for the next one
+        self.sent += len(data)
+        if data and self.observers:
+            self.observers.notify('chunk', 'upload', len(data))
+        return data
+    
+    def sendfile(self, sock):
+        while self.sent < self.size:
+            if self.terminated.is_set():
+                raise TransferCancelled()
+            sent = self.data.sendfile(sock, self.sent, self.chunksize)
+            self.sent += sent
+            if self.observers:
+                self.observers.notify('chunk', 'upload', sent)
+        return self.sent
+
+class RequestPlan(object):
+    # Everything but the cache-buster (and an upload's Content-Length) is built once per phase
+    def __init__(self, method, url, headers):
+        self.method = method
+        self.url = url
+        self.prefix = url.path + ('&' if url.parse.query else '?') + 'x='
+        self.headers = list(headers.items())
+        self.head = ''.join('%s: %s\r\n' % (name, value, ) for name, value in self.headers).encode('latin-1')
+        
+    def __repr__(self):
+        return '<RequestPlan: method={},url={}>'.format(self.method, self.url)
+    
+    @property
+    def path(self):
+        return '%s%.1f%d' % (self.prefix, time.time() * 1000.0, gcounter(), )
+    
+    def send(self, conn, body=None, length=None):
+        path = self.path
+        if isinstance(conn, RawHTTPConnection):
+            head = [b'%s %s HTTP/1.1\r\n' % (self.method.encode('ascii'), path.encode('latin-1'), ), self.head]
+            if length is not None:
+                head.append(b'Content-Length: %d\r\n' % (length, ))
+            head.append(b'\r\n')
+            conn.send_request(b''.join(head), body)
+            return path
+        conn.putrequest(self.method, path, skip_host=True, skip_accept_encoding=True)
+        for name, value in self.headers:
+            conn.putheader(name, value)
+        if length is not None:
+            conn.putheader('Content-Length', length)
+        conn.endheaders(body)
+        return path
 
-class HTTPUploader(threading.Thread, HttpClient):
-    def __init__(self, resultq, requestq, terminated, version='both'):
+class CircuitBreaker(object):
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+        
+    def __repr__(self):
+        return '<CircuitBreaker: failures={},open={}>'.format(self.failures, self.open)
+    
+    @property
+    def open(self):
+        return self.opened is not None and time.time() - self.opened < self.cooldown
+    
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened < self.cooldown:
+                return False
+            # Half-open: let one attempt through and hold the others back for another cooldown
+            self.opened = time.time()
+            return True
+        
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.threshold <= self.failures:
+                self.opened = time.time()
+
+class HTTPWorker(threading.Thread, HttpClient):
+    direction = None
+    
+    def __init__(self, resultq, requestq, terminated, connection_factory=None, observers=None, keepalive=False, breaker=None):
         super().__init__()
-        self.version = version
+        self.connection_factory = connection_factory or HTTPConnectionFactory()
+        self.observers = observers or Observers()
+        self.keepalive = keepalive
+        self.breaker = breaker
         self.requestq = requestq
         self.resultq = resultq
         self.terminated = terminated
-
+        self.conn = None
+        self.flow = None
+        self.flows = []
+        self.tcp = TCPInfoStats()
+        self.tripped = False
+        
+    def connect(self, url):
+        if self.conn is not None and self.conn.sock is not None:
+            return self.conn
+        self.disconnect()
+        if self.breaker and not self.breaker.allow():
+            raise CircuitOpen('{} is failing, stopping a {} connection'.format(url.netloc, self.direction))
+        conn = self.connection_factory(url)
+        try:
+            conn.connect()
+            self.connection_factory.tune(conn.sock)
+        except Exception:
+            conn.close()
+            raise
+        self.conn = conn
+        self.flow = {'connection': next(connection_counter), 'requests': 0, 'size': 0, 'start': time.time(), }
+        if self.observers:
+            self.observers.notify('connection_open', self.direction, self.conn)
+        return self.conn
+    
+    def disconnect(self):
+        if self.conn is None:
+            return
+        if self.flow['requests']:
+            info = tcp_info(self.conn.sock) if self.conn.sock else {}
+            self.tcp.complete(info)
+            if self.keepalive:
+                self.flow['finish'] = time.time()
+                self.flow['speed'] = self.flow['size'] * 8 / max(self.flow['finish'] - self.flow['start'], 1e-9)
+                self.flow['tcp'] = info
+                self.flows.append(self.flow)
+        self.conn.close()
+        self.conn = self.flow = None
+        
+    def complete(self, result):
+        self.flow['requests'] += 1
+        self.flow['size'] += result['size']
+        result['connection'] = self.flow['connection']
+        if self.breaker:
+            self.breaker.success()
+        if self.observers:
+            self.observers.notify('request_complete', self.direction, result)
+        self.resultq.put(result)
+        if not self.keepalive or result.get('partial'):
+            self.disconnect()
+            
+    def fail(self, e):
+        logger.error(e)
+        if self.breaker:
+            self.breaker.failure()
+        if self.observers:
+            self.observers.notify('error', self.direction, e)
+        self.resultq.put({'size': 0, 'elapsed': -1, })
+        self.disconnect()
+        
+    def transfer(self, request):
+        raise NotImplementedError()
+    
     def run(self):
-        def http_connection_cls(url):
-            return {
-                'http': http.client.HTTPConnection, 
-                'https': http.client.HTTPSConnection, }[url.scheme]
-
-        def http_upload_data_cls(preallocate=True):
-            return [
-                HTTPUploadData0,
-                HTTPUploadData][bool(preallocate)]
-
-        while not self.terminated.wait(timeout=0.1):
+        while not self.terminated.is_set():
             try:
-                url, size = self.requestq.get(timeout=0.1)
-                netloc = url.netloc
-                if self.version == 'ipv4':
-                    netloc = '%s:%d' % (url.resolve4, url.port)
-                elif self.version == 'ipv6':
-                    netloc = '[%s]:%d' % (url.resolve6, url.port)
-                data = http_upload_data_cls(preallocate=True)(size=size)
-                conn = http_connection_cls(url)(netloc)
-                start = time.time()
-                conn.request(
-                    'POST', url.anticache.path,
-                    headers={
-                        'Host': url.hostname,
-                        'User-Agent': self.user_agent,
-                        'Cache-Control': 'no-cache',
-                        'Content-Type': data.mime_type,
-                        'Content-Length': data.size, },
-                    body=data)
-                response = conn.getresponse()
-                response.read()
-                finish = time.time()
-                self.resultq.put({'size': data.size, 'elapsed': finish - start, })
-                # request = urllib.request.Request(url.anticache,
-                #     method='POST',
-                #     headers={
-                #         'User-Agent': self.user_agent,
-                #         'Cache-Control': 'no-cache',
-                #         'Content-Type': data.mime_type,
-                #         'Content-Length': data.size, },
-                #     data=data)
-                # start = time.time()
-                # with urllib.request.urlopen(request) as f:
-                #     f.read()
-                #     finish = time.time()
-                # self.resultq.put({'size': int(request.get_header('Content-length')), 'elapsed': finish - start, })
+                request = self.requestq.get(timeout=0.1)
             except queue.Empty:
-                pass
+                continue
+            try:
+                self.transfer(request)
+            except CircuitOpen as e:
+                # Only this worker gives up; one with a working connection keeps going
+                logger.warning(e)
+                self.requestq.put(request)
+                self.tripped = True
+                break
             except Exception as e:
-                logger.error(e)
-                self.resultq.put({'size': 0, 'elapsed': -1, })
+                self.fail(e)
+        self.disconnect()
 
-class HTTPDownloader(threading.Thread, HttpClient):
-    def __init__(self, resultq, requestq, terminated, version='both'):
-        super().__init__()
-        self.version = version
-        self.requestq = requestq
-        self.resultq = resultq
-        self.terminated = terminated
+class HTTPUploader(HTTPWorker):
+    direction = 'upload'
+    
+    def __init__(self, resultq, requestq, terminated, upload_data=HTTPUploadData, **kwargs):
+        super().__init__(resultq, requestq, terminated, **kwargs)
+        self.upload_data = upload_data
+
+    def sendfile(self, conn, plan, data):
+        if conn.sock is None:
+            conn.connect()
+        # Cork so the header block and the first body pages leave in the same segments
+        corked = hasattr(socket, 'TCP_CORK') and not isinstance(conn.sock, ssl.SSLSocket)
+        if corked:
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            plan.send(conn, length=data.size)
+            data.sendfile(conn.sock)
+        finally:
+            if corked:
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    def transfer(self, request):
+        plan, size = request
+        data = HTTPCancelableUploadData(self.upload_data(size=size), self.terminated, self.observers)
+        start = time.time()
+        conn = self.connect(plan.url)
+        connected = time.time()
+        if self.observers:
+            self.observers.notify('request_start', 'upload', plan.url, data.size)
+        try:
+            if data.zero_copy:
+                self.sendfile(conn, plan, data)
+            else:
+                plan.send(conn, body=data, length=data.size)
+        except TransferCancelled:
+            finish = time.time()
+            # data.sent counts what the kernel accepted; what is still queued or unacknowledged never reached the server
+            sent = max(data.sent - unsent_bytes(conn.sock), 0) if conn.sock is not None else data.sent
+            self.complete({'size': sent, 'elapsed': finish - start, 'connect': connected - start, 'partial': True, })
+            return
+        response = conn.getresponse()
+        first = time.time()
+        if self.observers:
+            self.observers.notify('first_byte', 'upload', first - start)
+        response.read()
+        finish = time.time()
+        self.complete({'size': data.size, 'elapsed': finish - start, 'connect': connected - start, 'ttfb': first - start, })
+        # request = urllib.request.Request(url.anticache,
+        #     method='POST',
+        #     headers={
+        #         'User-Agent': self.user_agent,
+        #         'Cache-Control': 'no-cache',
+        #         'Content-Type': data.mime_type,
+        #         'Content-Length': data.size, },
+        #     data=data)
+        # start = time.time()
+        # with urllib.request.urlopen(request) as f:
+        #     f.read()
+        #     finish = time.time()
+        # self.resultq.put({'size': int(request.get_header('Content-length')), 'elapsed': finish - start, })
+
+class HTTPDownloader(HTTPWorker):
+    direction = 'download'
+    chunksize = 64*1024
+    
+    def receive(self, response):
+        if not self.observers:
+            return len(response.read())
+        received = 0
+        buff = memoryview(bytearray(self.chunksize))
+        while (n := response.readinto(buff)):
+            received += n
+            self.observers.notify('chunk', 'download', n)
+        return received
         
-    def run(self):
-        def http_connection_cls(url):
-            return {
-                'http': http.client.HTTPConnection, 
-                'https': http.client.HTTPSConnection, }[url.scheme]
-
-        while not self.terminated.wait(timeout=0.1):
-            try:
-                url = self.requestq.get(timeout=0.1)
-                netloc = url.netloc
-                if self.version == 'ipv4':
-                    netloc = '%s:%d' % (url.resolve4, url.port)
-                elif self.version == 'ipv6':
-                    netloc = '[%s]:%d' % (url.resolve6, url.port)
-                conn = http_connection_cls(url)(netloc)
-                start = time.time()
-                conn.request(
-                    'GET', url.anticache.path,
-                    headers={
-                        'Host': url.hostname,
-                        'User-Agent': self.user_agent,
-                        'Cache-Control': 'no-cache', })
-                response = conn.getresponse()
-                data = response.read()
-                finish = time.time()
-                size = int(response.getheader('Content-Length', len(data)))
-                # request = urllib.request.Request(url.anticache,
-                #     method='GET',
-                #     headers={
-                #         'User-Agent': self.user_agent,
-                #         'Cache-Control': 'no-cache', })
-                # start = time.time()
-                # with urllib.request.urlopen(request) as f:
-                #     data = f.read()
-                #     finish = time.time()
-                #     size = int(f.headers.get('Content-Length', len(data)))
-                self.resultq.put({'size': size, 'elapsed': finish - start, })
-            except queue.Empty:
-                pass
-            except Exception as e:
-                logger.error(e)
-                self.resultq.put({'size': 0, 'elapsed': -1, })
+    def transfer(self, plan):
+        start = time.time()
+        conn = self.connect(plan.url)
+        connected = time.time()
+        if self.observers:
+            self.observers.notify('request_start', 'download', plan.url, 0)
+        plan.send(conn)
+        response = conn.getresponse()
+        first = time.time()
+        if self.observers:
+            self.observers.notify('first_byte', 'download', first - start)
+        received = self.receive(response)
+        finish = time.time()
+        size = int(response.getheader('Content-Length', received))
+        # request = urllib.request.Request(url.anticache,
+        #     method='GET',
+        #     headers={
+        #         'User-Agent': self.user_agent,
+        #         'Cache-Control': 'no-cache', })
+        # start = time.time()
+        # with urllib.request.urlopen(request) as f:
+        #     data = f.read()
+        #     finish = time.time()
+        #     size = int(f.headers.get('Content-Length', len(data)))
+        result = {'size': received, 'elapsed': finish - start, 'connect': connected - start, 'ttfb': first - start, }
+        if received < size:
+            result['partial'] = True
+        self.complete(result)
 
 class HTTPCancelableDownloader(HTTPDownloader):
+    def receive(self, response):
+        # Stops within one chunk of cancellation; the bytes read so far are credited as a partial result
+        received = 0
+        buff = memoryview(bytearray(self.chunksize))
+        while not self.terminated.is_set() and (n := response.readinto(buff)):
+            received += n
+            if self.observers:
+                self.observers.notify('chunk', 'download', n)
+        return received
+
+class TCPWorker(HTTPWorker):
+    def transfer(self, request):
+        url, size = request
+        start = time.time()
+        conn = self.connect(url)
+        connected = time.time()
+        if self.observers:
+            self.observers.notify('request_start', self.direction, url, size)
+        transferred, first = getattr(conn, self.direction)(size, self.terminated, self.observers)
+        finish = time.time()
+        result = {'size': transferred, 'elapsed': finish - start, 'connect': connected - start, }
+        if first:
+            result['ttfb'] = first - start
+            if self.observers:
+                self.observers.notify('first_byte', self.direction, first - start)
+        if transferred < size:
+            result['partial'] = True
+            # As for HTTP uploads, what the kernel still holds never reached the server
+            if self.direction == 'upload' and conn.sock is not None:
+                result['size'] = max(transferred - unsent_bytes(conn.sock), 0)
+        self.complete(result)
+
+class TCPDownloader(TCPWorker):
+    direction = 'download'
+
+class TCPUploader(TCPWorker):
+    direction = 'upload'
+
+class LatencyProber(threading.Thread):
+    def __init__(self, server, interval=0.2):
+        super().__init__(daemon=True)
+        self.server = server
+        self.interval = interval
+        self.sketch = QuantileSketch()
+        self.stopped = threading.Event()
+        
+    def probe(self, conn):
+        if isinstance(conn, TCPConnection):
+            return conn.ping()
+        path = self.server.url.join('/latency.txt').anticache.path
+        start = time.perf_counter()
+        conn.request('GET', path, headers={
+            'Host': self.server.url.hostname,
+            'User-Agent': get_user_agent(),
+            'Cache-Control': 'no-cache', })
+        response = conn.getresponse()
+        body = response.read()
+        if not (response.status == 200 and body[:9] == b'test=test'):
+            raise HttpRetrievalError()
+        return time.perf_counter() - start
+    
     def run(self):
-        while not self.terminated.wait(timeout=0.1):
+        # One keep-alive connection and a few tiny requests a second, so the probe itself barely loads the link
+        conn = None
+        while not self.stopped.is_set():
             try:
-                total = 0
-                chunksize = 8*1024
-                request = self.requestq.get(timeout=0.1)
-                request.add_header('User-Agent', self.user_agent)
-                start = time.time()
-                with urllib.request.urlopen(request) as f:
-                    while not self.terminated.is_set():
-                        data = f.read(chunksize)
-                        total += len(data)
-                        if len(data) < chunksize:
-                            break
-                    finish = time.time()
-                    size = int(f.headers.get('Content-Length', len(data)))
-                if total < size:
-                    raise Exception()
-                self.resultq.put({'size': size, 'elapsed': finish - start, })
-            except queue.Empty:
-                pass
-            except Exception as e:
-                logger.error(e)
-                self.resultq.put({'size': 0, 'elapsed': -1, })
+                if conn is None:
+                    conn = self.server.connection_factory(self.server.transfer_url)
+                    conn.connect()
+                self.sketch.append(self.probe(conn))
+            except (socket.error, ssl.SSLError, http.client.HTTPException, HttpRetrievalError) as e:
+                logger.debug(e)
+                if conn:
+                    conn.close()
+                conn = None
+            self.stopped.wait(self.interval)
+        if conn:
+            conn.close()
+            
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.sketch
+
+class TCPInfoSampler(threading.Thread):
+    def __init__(self, workers, interval=0.5):
+        super().__init__(daemon=True)
+        self.workers = workers
+        self.interval = interval
+        self.stats = TCPInfoStats()
+        self.stopped = threading.Event()
+        
+    def run(self):
+        # Workers replace and close their connections under us; a socket closed meanwhile just yields no sample
+        while not self.stopped.wait(self.interval):
+            for worker in self.workers:
+                conn = worker.conn
+                sock = conn.sock if conn is not None else None
+                if sock is not None:
+                    self.stats.append(tcp_info(sock))
+                    
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stats
 
 class Server(object):
+    transfer_target = 1.5 # seconds per request when --auto-size is in effect
+    warmup_length = None # caps the --auto-size warm-up below the configured test length
+    
     def __init__(self, testsuite, id, name, url, host, country, cc, sponsor, point):
         self.testsuite = testsuite
         self.id = int(id)
@@ -788,6 +2148,9 @@ class Server(object):
         self.cc = cc
         self.sponsor = sponsor
         self.point = point
+        self._source_address = None
+        self._protocol = None
+        self._ip_version = None
         
     @classmethod
     def fromElement(cls, testsuite, element):
@@ -804,6 +2167,19 @@ class Server(object):
         logger.debug('{!r}'.format(self))
         return self
         
+    @classmethod
+    def fromDict(cls, testsuite, value):
+        return cls(
+            testsuite=testsuite,
+            id=value['id'],
+            name=value['name'],
+            url=value['url'],
+            host=value['host'],
+            country=value['country'],
+            cc=value['cc'],
+            sponsor=value['sponsor'],
+            point=Point(latitude=value['location']['lat'], longitude=value['location']['lot']))
+        
     def __repr__(self):
         return '<Server: id={},name="{}",country="{}",cc="{}",url="{}",host="{}",sponsor="{}",point={!s},distance={:.2f},ipv4={},ipv6={}>'.format(self.id, self.name, self.country, self.cc, self.url.value, self.host, self.sponsor, self.point, self.distance, self.support_ipv4, self.support_ipv6)
     
@@ -826,6 +2202,64 @@ class Server(object):
             'sponsor': self.sponsor,
             'location': dict(self.point)}.items())
     
+    def clone(self):
+        server = copy.copy(self)
+        for name in list(vars(server)):
+            if name.startswith('_memoized_'):
+                delattr(server, name)
+        return server
+    
+    def bind(self, source_address):
+        server = self.clone()
+        server._source_address = source_address
+        return server
+    
+    def using(self, protocol):
+        server = self.clone()
+        server._protocol = protocol
+        return server
+    
+    def family(self, ip_version):
+        server = self.clone()
+        server._ip_version = ip_version
+        return server
+    
+    @property
+    def ip_version(self):
+        return self._ip_version or self.testsuite.ip_version
+    
+    @property
+    def source_address(self):
+        if self._source_address:
+            return self._source_address
+        return self.testsuite.source_address
+    
+    @property
+    def protocol(self):
+        if not self.host:
+            return 'http'
+        return self._protocol or self.testsuite.option.args.protocol
+    
+    @property
+    @memoized
+    def breaker(self):
+        return CircuitBreaker()
+    
+    @property
+    @memoized
+    def tcp_url(self):
+        return URL('tcp://' + self.host)
+    
+    @property
+    def transfer_url(self):
+        return self.tcp_url if self.protocol == 'tcp' else self.url
+    
+    @property
+    def connection_factory(self):
+        if self.protocol == 'tcp':
+            return TCPConnectionFactory(version=self.ip_version, source_address=self.source_address, timeout=self.testsuite.option.args.timeout, rcvbuf=self.testsuite.option.args.rcvbuf, sndbuf=self.testsuite.option.args.sndbuf, nodelay=self.testsuite.option.args.nodelay)
+        return HTTPConnectionFactory(version=self.ip_version, source_address=self.source_address, tls_sessions=self.testsuite.tls_sessions, engine=self.testsuite.option.args.engine, timeout=self.testsuite.option.args.timeout, rcvbuf=self.testsuite.option.args.rcvbuf, sndbuf=self.testsuite.option.args.sndbuf, nodelay=self.testsuite.option.args.nodelay)
+    
     @property
     def support_ipv4(self):
         return self.url.can_resolve4()
@@ -839,17 +2273,37 @@ class Server(object):
     def distance(self):
         return self.testsuite.client.point.distance_to(self.point)
     
-    @property
-    @memoized
-    def latency(self):
-        def http_connection_cls(scheme):
-            return {
-                'http': http.client.HTTPConnection, 
-                'https': http.client.HTTPSConnection, }[scheme]
-
+    def measure_tcp_latency(self, count=3):
+        # Connect plus HI/HELLO, the counterpart of connect plus GET /latency.txt over HTTP
         latencies = []
-        for _ in range(3):
-            conn = http_connection_cls(self.url.scheme)(self.url.netloc)
+        for _ in range(count):
+            if not self.breaker.allow():
+                latencies.append(3600.0)
+                continue
+            conn = self.connection_factory(self.tcp_url)
+            try:
+                start = time.perf_counter()
+                conn.connect()
+                latencies.append(time.perf_counter() - start)
+                self.breaker.success()
+                logger.debug('{!s} {} {!s}'.format(self.tcp_url.netloc, conn.hello, latencies))
+            except (socket.error, ProtocolError) as e:
+                logger.error(e)
+                self.breaker.failure()
+                latencies.append(3600.0)
+            finally:
+                conn.close()
+        return latencies
+    
+    def measure_latency(self, count=3):
+        if self.protocol == 'tcp':
+            return self.measure_tcp_latency(count)
+        latencies = []
+        for _ in range(count):
+            if not self.breaker.allow():
+                latencies.append(3600.0)
+                continue
+            conn = self.connection_factory(self.url)
             try:
                 start = time.perf_counter()
                 conn.request(
@@ -863,57 +2317,220 @@ class Server(object):
                 if not (response.status == 200 and response.read(9) == b'test=test'):
                     raise HttpRetrievalError()
                 latencies.append(latency)
+                self.breaker.success()
                 logger.debug('{!s} GET {} => {} {!s}'.format(self.url.hostname, self.url.join('/latency.txt').anticache.path, response.status, latencies))
             except (urllib.error.HTTPError, urllib.error.URLError, socket.error, ssl.SSLError, ssl.CertificateError, http.client.BadStatusLine, HttpRetrievalError) as e:
                 logger.error(e)
+                self.breaker.failure()
                 latencies.append(3600.0)
             finally:
                 if conn:
                     conn.close()
                 conn = None
-        return round((sum(latencies) / (len(latencies)*2)) * 1000.0, 3)
+        return latencies
+    
+    @property
+    @memoized
+    def latencies(self):
+        return self.measure_latency()
+    
+    @property
+    @memoized
+    def latency(self):
+        return round((sum(self.latencies) / (len(self.latencies)*2)) * 1000.0, 3)
     ping=latency
     
-    def do_download(self, threads=2):
-        terminated = threading.Event()
-        requestq = multiprocessing.Queue()
-        resultq = multiprocessing.Queue()
-        for _ in range(threads):
-            HTTPDownloader(resultq=resultq, requestq=requestq, terminated=terminated, version=self.testsuite.ip_version).start()
-        
-        request_paths = []
+    def start_prober(self):
+        if not self.testsuite.option.args.loaded_latency:
+            return None
+        prober = LatencyProber(self)
+        prober.start()
+        return prober
+    
+    def download_sizes(self, threads, length):
+        if self.testsuite.option.args.auto_size:
+            sizes = self.plan_download(threads, length)
+            if sizes:
+                return sizes
+        sizes = []
         for size in self.testsuite.config.params['download']['sizes']:
             for _ in range(self.testsuite.config.params['download']['counts']):
-                request_paths.append('/random%sx%s.jpg' % (size, size, ))
-                
-        for request_path in request_paths:
-            requestq.put(self.url.join(request_path))
+                sizes.append(size)
+        return sizes
+    
+    def plan_download(self, threads, length):
+        # Pick the image that takes about transfer_target seconds per connection at the warm-up speed
+        params = self.testsuite.config.params['download']
+        if not self.warmup_download.total_size:
+            logger.warning('Download warm-up failed, using the configured sizes')
+            return None
+        speed = self.warmup_download.speed / threads
+        wanted = max(speed / 8 * self.transfer_target, int(params['mintestsize'].value))
+        size = min([size for size, nbytes in sorted(DOWNLOAD_SIZES.items()) if wanted <= nbytes] or [max(DOWNLOAD_SIZES)])
+        # Queue twice what the estimate needs; the phase deadline discards the surplus
+        count = threads * int(math.ceil(length / self.transfer_target)) * 2
+        logger.debug('speed={:.0f} size={} count={}'.format(speed, size, count))
+        return [size] * count
+    
+    @property
+    @memoized
+    def warmup_download(self):
+        initialtest = int(self.testsuite.config.params['download']['initialtest'].value)
+        size = min([size for size, nbytes in sorted(DOWNLOAD_SIZES.items()) if initialtest <= nbytes] or [max(DOWNLOAD_SIZES)])
+        return self.run_download([size], threads=1, length=min(filter(None, [self.testsuite.config.params['download']['length'], self.warmup_length])))
+    
+    def run_tcp(self, results, worker, requests, threads, length, cancelled=None):
+        terminated = threading.Event()
+        requestq = queue.Queue()
+        resultq = queue.Queue()
+        for request in requests:
+            requestq.put(request)
+        # The protocol keeps connections open between commands, so the workers always do too
+        workers = [worker(resultq=resultq, requestq=requestq, terminated=terminated, connection_factory=self.connection_factory, observers=self.testsuite.observers, keepalive=True, breaker=self.breaker) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        return self.gather(results, resultq, len(requests), workers, terminated, length=length, cancelled=cancelled)
+    
+    def run_download(self, sizes, threads, length, cancelled=None):
+        if self.protocol == 'tcp':
+            return self.run_tcp(DownloadResults(), TCPDownloader, [(self.tcp_url, DOWNLOAD_SIZES.get(size, size), ) for size in sizes], threads, length, cancelled=cancelled)
+        terminated = threading.Event()
+        requestq = queue.Queue()
+        resultq = queue.Queue()
+        plans = {}
+        for size in sizes:
+            if size not in plans:
+                url = self.url.join('/random%sx%s.jpg' % (size, size, ))
+                plans[size] = RequestPlan('GET', url, {
+                    'Host': url.hostname,
+                    'User-Agent': get_user_agent(),
+                    'Cache-Control': 'no-cache', })
+            requestq.put(plans[size])
+        workers = [HTTPCancelableDownloader(resultq=resultq, requestq=requestq, terminated=terminated, connection_factory=self.connection_factory, observers=self.testsuite.observers, keepalive=self.testsuite.option.args.single, breaker=self.breaker) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        return self.gather(DownloadResults(), resultq, len(sizes), workers, terminated, length=length, cancelled=cancelled)
+    
+    def do_download(self, threads=2, length=None, sizes=None, cancelled=None):
+        if length is None:
+            length = self.testsuite.config.params['download']['length']
+        if self.testsuite.option.args.single:
+            threads = 1
+        if sizes is None:
+            sizes = self.download_sizes(threads, length)
+        prober = self.start_prober()
+        results = self.run_download(sizes, threads, length, cancelled=cancelled)
+        if prober:
+            results.loaded_latency.merge(prober.stop())
+        if self.testsuite.observers:
+            self.testsuite.observers.notify('phase_end', 'download', results)
+        return results
         
-        results = DownloadResults()
-        for _ in range(len(request_paths)):
-            results.append(resultq.get())
+    def gather(self, results, resultq, count, workers, terminated, length=None, cancelled=None):
+        sampler = TCPInfoSampler(workers) if hasattr(socket, 'TCP_INFO') else None
+        if sampler:
+            sampler.start()
+        results.start = time.time()
+        deadline = results.start + length if length else None
+        while count:
+            if deadline and deadline <= time.time() or cancelled is not None and cancelled.is_set():
+                terminated.set()
+            # Workers also stop on their own once the circuit breaker opens
+            if not any(map(lambda worker: worker.is_alive(), workers)):
+                break
+            try:
+                results.append(resultq.get(timeout=0.1))
+                count -= 1
+            except queue.Empty:
+                pass
+        results.finish = time.time()
         terminated.set()
+        for worker in workers:
+            worker.join()
+            results.flows.extend(worker.flows)
+            results.tcp.merge(worker.tcp)
+            results.tripped |= worker.tripped
+        if sampler:
+            results.tcp.merge(sampler.stop())
+        while True:
+            try:
+                results.append(resultq.get_nowait())
+            except queue.Empty:
+                break
         return results
-        
-    def do_upload(self, threads=2):
-        terminated = threading.Event()
-        requestq = multiprocessing.Queue()
-        resultq = multiprocessing.Queue()
-        for _ in range(threads):
-            HTTPUploader(resultq=resultq, requestq=requestq, terminated=terminated, version=self.testsuite.ip_version).start()
-        
+    
+    def upload_sizes(self, threads, length):
+        if self.testsuite.option.args.auto_size:
+            sizes = self.plan_upload(threads, length)
+            if sizes:
+                return sizes
         sizes = []
         for size in self.testsuite.config.params['upload']['sizes']:
             for _ in range(self.testsuite.config.params['upload']['counts']):
                 sizes.append(size)
-
+        return sizes
+    
+    def plan_upload(self, threads, length):
+        params = self.testsuite.config.params['upload']
+        if not self.warmup_upload.total_size:
+            logger.warning('Upload warm-up failed, using the configured sizes')
+            return None
+        speed = self.warmup_upload.speed / threads
+        size = int(min(max(speed / 8 * self.transfer_target, int(params['mintestsize'].value)), UPLOAD_MAX_SIZE))
+        # Queue twice what the estimate needs; the phase deadline discards the surplus
+        count = threads * int(math.ceil(length / self.transfer_target)) * 2
+        logger.debug('speed={:.0f} size={} count={}'.format(speed, size, count))
+        return [size] * count
+    
+    @property
+    @memoized
+    def warmup_upload(self):
+        initialtest = int(self.testsuite.config.params['upload']['initialtest'].value)
+        return self.run_upload([initialtest], threads=1, length=min(filter(None, [self.testsuite.config.params['upload']['length'], self.warmup_length])))
+    
+    def run_upload(self, sizes, threads, length, cancelled=None):
+        if self.protocol == 'tcp':
+            return self.run_tcp(UploadResults(), TCPUploader, [(self.tcp_url, size, ) for size in sizes], threads, length, cancelled=cancelled)
+        terminated = threading.Event()
+        requestq = queue.Queue()
+        resultq = queue.Queue()
+        payload = None
+        if self.testsuite.option.args.zero_copy and ZeroCopyPayload.supported():
+            payload = ZeroCopyPayload(max(sizes))
+            upload_data = functools.partial(HTTPZeroCopyUploadData, payload)
+        else:
+            upload_data = [
+                HTTPUploadData0,
+                HTTPUploadData][bool(self.testsuite.option.args.pre_allocate)]
+        plan = RequestPlan('POST', self.url, {
+            'Host': self.url.hostname,
+            'User-Agent': get_user_agent(),
+            'Cache-Control': 'no-cache',
+            'Content-Type': 'application/x-www-form-urlencoded', })
         for size in sizes:
-            requestq.put((self.url, size))
+            requestq.put((plan, size))
+        workers = [HTTPUploader(resultq=resultq, requestq=requestq, terminated=terminated, upload_data=upload_data, connection_factory=self.connection_factory, observers=self.testsuite.observers, keepalive=self.testsuite.option.args.single, breaker=self.breaker) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
         
-        results = UploadResults()
-        for _ in range(len(sizes)):
-            results.append(resultq.get())
-        terminated.set()
+        results = self.gather(UploadResults(), resultq, len(sizes), workers, terminated, length=length, cancelled=cancelled)
+        if payload:
+            payload.close()
+        return results
+    
+    def do_upload(self, threads=2, length=None, sizes=None, cancelled=None):
+        if length is None:
+            length = self.testsuite.config.params['upload']['length']
+        if self.testsuite.option.args.single:
+            threads = 1
+        if sizes is None:
+            sizes = self.upload_sizes(threads, length)
+        prober = self.start_prober()
+        results = self.run_upload(sizes, threads, length, cancelled=cancelled)
+        if prober:
+            results.loaded_latency.merge(prober.stop())
+        if self.testsuite.observers:
+            self.testsuite.observers.notify('phase_end', 'upload', results)
         return results
 
     @property
@@ -944,7 +2561,7 @@ class MiniServer(Server):
             request_url = url.geturl().rstrip('/')
         logger.debug(request_url)
         
-        client = HttpClient()
+        client = HttpClient(source_address=testsuite.source_address, timeout=testsuite.option.args.timeout)
         response = client.get(request_url)
         extensions = re.findall(r'upload_?[Ee]xtension: "([^"]+)"', response)
         if not extensions:
@@ -975,6 +2592,10 @@ class MiniServer(Server):
     def distance(self):
         return 0.0
         
+    @property
+    def latencies(self):
+        return []
+    
     @property
     def latency(self):
         return 0.0
@@ -995,10 +2616,192 @@ class NullServer(Server):
     def distance(self):
         return 0.0
         
+    @property
+    def latencies(self):
+        return []
+    
     @property
     def latency(self):
         return 0.0
 
+class ConcurrentTest(object):
+    def __init__(self, servers):
+        self.servers = list(servers)
+        
+    def run(self, direction):
+        results = ConcurrentResults()
+        def worker(server):
+            results.append(server, getattr(server, 'do_%s' % (direction, ))())
+        
+        threads = [threading.Thread(target=worker, args=(server, )) for server in self.servers]
+        results.start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results.finish = time.time()
+        results.results.sort(key=lambda _: self.servers.index(_[0]))
+        return results
+    
+    @property
+    @memoized
+    def download(self):
+        return self.run('download')
+    
+    @property
+    @memoized
+    def upload(self):
+        return self.run('upload')
+
+class AdaptiveResults(object):
+    def __init__(self, stats, confidence, reason, results):
+        self.stats = stats
+        self.confidence = confidence
+        self.reason = reason
+        self.results = results
+        
+    def __repr__(self):
+        return '<AdaptiveResults: speed={:.0f},halfwidth={:.0f},windows={},reason={}>'.format(self.speed, self.halfwidth, self.windows, self.reason)
+    
+    def __iter__(self):
+        return iter({
+            'speed': self.speed,
+            'lower': self.lower,
+            'upper': self.upper,
+            'confidence': self.confidence,
+            'windows': self.windows,
+            'reason': self.reason}.items())
+    
+    @property
+    def speed(self):
+        return self.stats.mean
+    
+    @property
+    def windows(self):
+        return self.stats.count
+    
+    @property
+    def halfwidth(self):
+        if self.stats.count < 2:
+            return math.inf
+        return student_t(self.confidence, self.stats.count - 1) * self.stats.stdev / math.sqrt(self.stats.count)
+    
+    @property
+    def lower(self):
+        return max(self.speed - self.halfwidth, 0.0)
+    
+    @property
+    def upper(self):
+        return self.speed + self.halfwidth
+
+class AdaptiveTest(object):
+    def __init__(self, server, width=0.05, confidence=0.95, budget=60.0, window=3.0, minimum=3, maximum=20):
+        self.server = server
+        self.width = width # of the mean, across the whole interval
+        self.confidence = confidence
+        self.budget = budget
+        self.window = window
+        self.minimum = minimum
+        self.maximum = maximum
+        
+    def __repr__(self):
+        return '<AdaptiveTest: width={},confidence={},budget={},window={}>'.format(self.width, self.confidence, self.budget, self.window)
+    
+    def sizes(self, server, direction):
+        # One request size, picked from a warm-up, for every window; the default schedule would restart at the smallest requests each time
+        threads = 1 if server.testsuite.option.args.single else 2
+        sizes = getattr(server, 'plan_' + direction)(threads, self.window)
+        if not sizes:
+            params = server.testsuite.config.params[direction]
+            sizes = [max(params['sizes'])] * params['counts'] * threads
+        return sizes
+    
+    def run(self, direction):
+        stats = RunningStats()
+        results = {'download': DownloadResults, 'upload': UploadResults}[direction]()
+        estimate = AdaptiveResults(stats, self.confidence, 'maximum', results)
+        start = time.time()
+        # A copy, so the shortened warm-up stays local to this test
+        server = self.server.clone()
+        server.warmup_length = self.window
+        sizes = self.sizes(server, direction)
+        while stats.count < self.maximum:
+            if self.minimum <= stats.count and estimate.halfwidth * 2 <= self.width * estimate.speed:
+                estimate.reason = 'converged'
+                break
+            if self.budget < time.time() - start + self.window:
+                estimate.reason = 'budget'
+                break
+            window = getattr(server, 'do_' + direction)(length=self.window, sizes=sizes)
+            stats.append(window.wallclock_speed or window.speed)
+            results.merge(window)
+            logger.debug('{!r}'.format(estimate))
+        return estimate
+    
+    @property
+    @memoized
+    def download(self):
+        return self.run('download')
+    
+    @property
+    @memoized
+    def upload(self):
+        return self.run('upload')
+
+class BatchTest(object):
+    def __init__(self, testsuite, targets, jobs=4, budget=30.0):
+        self.testsuite = testsuite
+        self.targets = targets
+        self.jobs = jobs
+        self.budget = budget
+        
+    def __repr__(self):
+        return '<BatchTest: jobs={},budget={}>'.format(self.jobs, self.budget)
+    
+    def resolve(self, target):
+        if str(target).isdigit():
+            # A fresh copy, so an ID listed twice is measured twice
+            return self.testsuite.servers.findById(int(target)).bind(None)
+        return MiniServer(self.testsuite, url=target)
+    
+    def measure(self, target):
+        deadline = time.time() + self.budget
+        server = self.resolve(target)
+        server.latency
+        # Each phase gets an even share of what is left of the budget, --auto-size warm-ups included
+        server.warmup_length = max(self.budget / 8, 0.1)
+        auto_size = self.testsuite.option.args.auto_size
+        download = None
+        if self.testsuite.option.args.download:
+            if auto_size:
+                server.warmup_download
+            download = server.do_download(length=max(min(self.testsuite.config.params['download']['length'], (deadline - time.time()) / 2), 0.1))
+        upload = None
+        if self.testsuite.option.args.upload:
+            if auto_size:
+                server.warmup_upload
+            upload = server.do_upload(length=max(min(self.testsuite.config.params['upload']['length'], deadline - time.time()), 0.1))
+        return TestSuiteResults(self.testsuite, download, upload, server=server)
+    
+    def __iter__(self):
+        import concurrent.futures
+        # Only jobs targets are ever in flight, so memory stays flat however long the list is
+        targets = iter(self.targets)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = {executor.submit(self.measure, target): target for target in itertools.islice(targets, self.jobs)}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    target = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error('{}: {!r}'.format(target, e))
+                        result = e
+                    yield target, result
+                for target in itertools.islice(targets, len(done)):
+                    pending[executor.submit(self.measure, target)] = target
+
 class Servers(object):
     def __init__(self, testsuite):
         self.testsuite = testsuite
@@ -1006,8 +2809,9 @@ class Servers(object):
     @property
     @memoized
     def servers(self):
+        import xml.dom.minidom
         servers = []
-        http = HttpClient()
+        http = HttpClient(source_address=self.testsuite.source_address, timeout=self.testsuite.option.args.timeout)
         urls = [
             'https://www.speedtest.net/speedtest-servers-static.php',
             'http://c.speedtest.net/speedtest-servers-static.php',
@@ -1054,10 +2858,479 @@ class Servers(object):
             return sorted(servers, key=lambda server: server.distance)
         return sort_by_distance(self.servers)[:limit]
 
+class ServerMemory(object):
+    def __init__(self, path=None, history=8, threshold=1.5, slack=0.005, ttl=7*24*3600):
+        self.path = path or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'speedtest', 'servers.json')
+        self.history = history
+        self.threshold = threshold
+        self.slack = slack # seconds, keeps sub-millisecond RTTs from flapping
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        
+    def __repr__(self):
+        return '<ServerMemory: path={},history={},threshold={}>'.format(self.path, self.history, self.threshold)
+    
+    @property
+    @memoized
+    def state(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(e)
+            return {}
+        
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.warning(e)
+            
+    @staticmethod
+    def key(testsuite):
+        return '{}|{}|{}'.format(testsuite.client.ipaddr, testsuite.ip_version, testsuite.source_address or '')
+    
+    @staticmethod
+    def median(values):
+        values = sorted(values)
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+    
+    def remember(self, entry, server, latencies):
+        history = entry.setdefault('latencies', {}).setdefault(str(server.id), [])
+        history.extend(latencies)
+        del history[:-self.history]
+        
+    def recall(self, testsuite):
+        with self.lock:
+            entry = self.state.get(self.key(testsuite))
+            if not entry or time.time() - entry['updated'] > self.ttl:
+                return None
+            if entry['server']['id'] in testsuite.config.params['ignore_servers'] + testsuite.option.args.exclude:
+                return None
+            server = Server.fromDict(testsuite, entry['server'])
+            latencies = server.measure_latency(count=1)
+            baseline = self.median(entry['latencies'].get(str(server.id)) or latencies)
+            if latencies[0] >= 3600.0 or baseline * self.threshold + self.slack < latencies[0]:
+                logger.info('Remembered server {} degraded ({:.1f}ms, usually {:.1f}ms)'.format(server.id, latencies[0] * 1000.0, baseline * 1000.0))
+                return None
+            server._memoized_latencies = latencies
+            self.remember(entry, server, latencies)
+            self.save()
+            return server
+        
+    def record(self, testsuite, server, candidates):
+        with self.lock:
+            entry = self.state.setdefault(self.key(testsuite), {})
+            entry['server'] = dict(server)
+            entry['address'] = server.url.resolve6 if testsuite.ip_version == 'ipv6' else server.url.resolve4 or server.url.resolve6
+            entry['updated'] = time.time()
+            for candidate in candidates:
+                self.remember(entry, candidate, [_ for _ in candidate.latencies if _ < 3600.0])
+            self.save()
+
+class RollingRate(object):
+    def __init__(self, window=2.0):
+        self.window = window
+        self.samples = collections.deque()
+        
+    def sample(self, total, now=None):
+        now = time.time() if now is None else now
+        self.samples.append((now, total, ))
+        while 2 < len(self.samples) and self.window < now - self.samples[1][0]:
+            self.samples.popleft()
+            
+    @property
+    def rate(self):
+        if len(self.samples) < 2:
+            return 0.0
+        (start, first), (finish, last) = self.samples[0], self.samples[-1]
+        if finish <= start:
+            return 0.0
+        return (last - first) / (finish - start)
+
+class ProgressCounter(object):
+    __slots__ = ('bytes', 'active', )
+    
+    def __init__(self):
+        self.bytes = 0
+        self.active = 0
+
+class ProgressMonitor(Observer):
+    def __init__(self, stream=None, interval=0.25, window=2.0, units=('bit', 1, )):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.units = units
+        # Each worker thread only ever writes its own counter; the display thread just sums them
+        self.counters = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.rate = RollingRate(window)
+        self.direction = None
+        self.phase_start = None
+        self.baseline = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        
+    @property
+    def counter(self):
+        try:
+            return self.local.counter
+        except AttributeError:
+            counter = self.local.counter = ProgressCounter()
+            with self.lock:
+                self.counters.append(counter)
+            return counter
+        
+    def request_start(self, direction, url, size):
+        if self.phase_start is None:
+            self.direction = direction
+            self.phase_start = time.time()
+        self.counter.active = 1
+        
+    def chunk(self, direction, size):
+        self.counter.bytes += size
+        
+    def request_complete(self, direction, result):
+        self.counter.active = 0
+        
+    def error(self, direction, e):
+        self.counter.active = 0
+        
+    def phase_end(self, direction, results):
+        with self.lock:
+            self.baseline = sum(map(lambda _: _.bytes, self.counters))
+            self.phase_start = None
+            self.rate = RollingRate(self.rate.window)
+            self.stream.write('\r\033[K')
+            self.stream.flush()
+            
+    def render(self):
+        with self.lock:
+            counters = list(self.counters)
+            total = sum(map(lambda _: _.bytes, counters))
+            active = sum(map(lambda _: _.active, counters))
+            if self.phase_start is None:
+                return
+            self.rate.sample(total * 8)
+            self.stream.write('\r\033[K{direction}: {speed}{unit}/s  {elapsed:.1f}s  {size}B  {active} streams'.format(
+                direction=self.direction.capitalize(),
+                speed=units.Bandwidth(self.rate.rate) / self.units[1],
+                unit=self.units[0],
+                elapsed=time.time() - self.phase_start,
+                size=units.Size(total - self.baseline),
+                active=active))
+            self.stream.flush()
+            
+    def run(self):
+        while not self.stopped.wait(timeout=self.interval):
+            self.render()
+            
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+class ProgressCallback(Observer):
+    def __init__(self, callback, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        # Workers only bump their own counter; the host callback runs on the reporting thread, never on a worker
+        self.counters = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.direction = None
+        self.baseline = 0
+        self.reported = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        
+    @property
+    def counter(self):
+        try:
+            return self.local.counter
+        except AttributeError:
+            counter = self.local.counter = ProgressCounter()
+            with self.lock:
+                self.counters.append(counter)
+            return counter
+        
+    def request_start(self, direction, url, size):
+        if self.direction is None:
+            self.direction = direction
+        
+    def chunk(self, direction, size):
+        self.counter.bytes += size
+        
+    def phase_end(self, direction, results):
+        with self.lock:
+            self.baseline = sum(map(lambda _: _.bytes, self.counters))
+            self.reported = 0
+            self.direction = None
+            self.callback(direction, results.total_size)
+            
+    def report(self):
+        with self.lock:
+            transferred = sum(map(lambda _: _.bytes, self.counters)) - self.baseline
+            if self.direction is None or transferred == self.reported:
+                return
+            self.reported = transferred
+            self.callback(self.direction, transferred)
+            
+    def run(self):
+        while not self.stopped.wait(timeout=self.interval):
+            self.report()
+            
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+class SampleExporter(Observer):
+    fields = ('timestamp', 'direction', 'server', 'connection', 'size', 'connect', 'ttfb', 'elapsed', 'partial', 'error', )
+    
+    def __init__(self, stream, format='csv', maxsize=4096):
+        self.stream = stream
+        self.format = format
+        # Workers never block on the writer; once the queue is full further samples are counted and dropped
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.writer = None
+        self.thread = None
+        
+    def __repr__(self):
+        return '<SampleExporter: format={},pending={},dropped={}>'.format(self.format, self.queue.qsize(), self.dropped)
+    
+    def put(self, sample):
+        try:
+            self.queue.put_nowait(sample)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                
+    def request_start(self, direction, url, size):
+        self.local.server = url.netloc
+        
+    def request_complete(self, direction, result):
+        self.put((time.time(), direction, getattr(self.local, 'server', ''), result.get('connection'), result['size'], result.get('connect'), result.get('ttfb'), result['elapsed'], bool(result.get('partial')), None, ))
+        
+    def error(self, direction, e):
+        self.put((time.time(), direction, getattr(self.local, 'server', ''), None, 0, None, None, None, False, repr(e), ))
+        
+    def write(self, sample):
+        if self.writer:
+            self.writer.writerow(sample)
+        else:
+            self.stream.write(json.dumps(dict(zip(self.fields, sample))) + '\n')
+            
+    def run(self):
+        while (sample := self.queue.get()) is not None:
+            self.write(sample)
+            if self.queue.empty():
+                self.stream.flush()
+                
+    def start(self):
+        if self.format == 'csv':
+            import csv
+            self.writer = csv.writer(self.stream)
+            self.writer.writerow(self.fields)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+        self.stream.flush()
+        if self.dropped:
+            logger.warning('{} samples dropped, the output could not keep up'.format(self.dropped))
+
+class MetricsRequestHandler(object):
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = self.server.exporter.render(openmetrics=openmetrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', [
+            'text/plain; version=0.0.4; charset=utf-8',
+            'application/openmetrics-text; version=1.0.0; charset=utf-8'][openmetrics])
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class MetricsCounter(object):
+    __slots__ = ('bytes', 'requests', 'errors', 'inflight', )
+    
+    def __init__(self, directions):
+        self.bytes = dict.fromkeys(directions, 0)
+        self.requests = dict.fromkeys(directions, 0)
+        self.errors = dict.fromkeys(directions, 0)
+        self.inflight = 0
+
+class MetricsExporter(Observer):
+    speed_buckets = (1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 1e10, )
+    time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, )
+    directions = ('download', 'upload', )
+    
+    def __init__(self, address=('', 9469), interval=0.5):
+        self.address = address
+        self.interval = interval
+        # As in ProgressMonitor, each worker thread only writes its own counter and readers sum them
+        self.counters = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.throughput = RollingRate()
+        self.results = {}
+        self.latencies = []
+        self.httpd = None
+        self.stopped = threading.Event()
+        
+    @property
+    def counter(self):
+        try:
+            return self.local.counter
+        except AttributeError:
+            counter = self.local.counter = MetricsCounter(self.directions)
+            with self.lock:
+                self.counters.append(counter)
+            return counter
+        
+    def total(self, name, direction=None):
+        with self.lock:
+            counters = list(self.counters)
+        if direction is None:
+            return sum(map(lambda _: getattr(_, name), counters))
+        return sum(map(lambda _: getattr(_, name)[direction], counters))
+    
+    def request_start(self, direction, url, size):
+        self.counter.inflight = 1
+        
+    def chunk(self, direction, size):
+        self.counter.bytes[direction] += size
+        
+    def request_complete(self, direction, result):
+        counter = self.counter
+        counter.inflight = 0
+        counter.requests[direction] += 1
+        
+    def error(self, direction, e):
+        counter = self.counter
+        counter.inflight = 0
+        counter.errors[direction] += 1
+        
+    def phase_end(self, direction, results):
+        with self.lock:
+            self.results[direction] = results
+            
+    def update(self, results):
+        with self.lock:
+            self.results.update(results.directions)
+            self.latencies = list(results.server.latencies)
+            
+    def tick(self):
+        while not self.stopped.wait(timeout=self.interval):
+            self.throughput.sample(sum(self.total('bytes', direction) for direction in self.directions) * 8)
+            
+    def serve(self):
+        import http.server
+        handler = type('MetricsRequestHandler', (MetricsRequestHandler, http.server.BaseHTTPRequestHandler, ), {})
+        self.httpd = http.server.ThreadingHTTPServer(self.address, handler)
+        self.httpd.exporter = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self.tick, daemon=True).start()
+        logger.debug('Serving metrics on {!r}'.format(self.httpd.server_address))
+        return self
+    
+    def shutdown(self):
+        self.stopped.set()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            
+    def render(self, openmetrics=False):
+        def format_value(value):
+            if value == math.inf:
+                return '+Inf'
+            return repr(value)
+        
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('{}="{}"'.format(key, value) for key, value in labels.items())
+        
+        def histgram(sketch, buckets, labels={}):
+            for bound in buckets:
+                yield ('_bucket', merge_dict({'le': format_value(float(bound))}, labels), sketch.rank(bound), )
+            yield ('_bucket', merge_dict({'le': '+Inf'}, labels), sketch.count, )
+            yield ('_count', labels, sketch.count, )
+            yield ('_sum', labels, sketch.total, )
+            
+        lines = []
+        def metric(name, kind, text, samples):
+            family = name[:-len('_total')] if openmetrics and kind == 'counter' else name
+            lines.append('# HELP {} {}'.format(family, text))
+            lines.append('# TYPE {} {}'.format(family, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, format_labels(labels), format_value(value)))
+        
+        metric('speedtest_throughput_bits_per_second', 'gauge', 'Current aggregate throughput.',
+            [('', {}, self.throughput.rate)])
+        metric('speedtest_active_requests', 'gauge', 'Requests currently in flight.',
+            [('', {}, self.total('inflight'))])
+        metric('speedtest_bytes_total', 'counter', 'Bytes transferred.',
+            [('', {'direction': direction}, self.total('bytes', direction)) for direction in self.directions])
+        metric('speedtest_requests_total', 'counter', 'Completed requests.',
+            [('', {'direction': direction}, self.total('requests', direction)) for direction in self.directions])
+        metric('speedtest_errors_total', 'counter', 'Failed requests.',
+            [('', {'direction': direction}, self.total('errors', direction)) for direction in self.directions])
+        with self.lock:
+            results = dict(self.results)
+            latencies = list(self.latencies)
+            
+        metric('speedtest_last_speed_bits_per_second', 'gauge', 'Throughput of the last completed run.',
+            [('', {'direction': direction}, results[direction].wallclock_speed or results[direction].speed) for direction in self.directions if direction in results and results[direction].total_elapsed])
+        metric('speedtest_request_speed_bits_per_second', 'histogram', 'Per-request throughput of the last run.',
+            [sample for direction in self.directions if direction in results for sample in histgram(results[direction].sketch, self.speed_buckets, {'direction': direction})])
+        metric('speedtest_request_phase_seconds', 'histogram', 'Per-request phase timings of the last run.',
+            [sample for direction in self.directions if direction in results for phase, sketch in results[direction].phases.items() for sample in histgram(sketch, self.time_buckets, {'direction': direction, 'phase': phase})])
+        # Failed probes are recorded as 3600 seconds; they are counted apart rather than skewing the histogram
+        sketch = QuantileSketch()
+        for latency in latencies:
+            if latency < 3600.0:
+                sketch.append(latency)
+        metric('speedtest_latency_seconds', 'histogram', 'Round-trip times of the last latency probe.',
+            list(histgram(sketch, self.time_buckets)))
+        metric('speedtest_latency_failures_total', 'counter', 'Failed round trips of the last latency probe.',
+            [('', {}, len(latencies) - sketch.count)])
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
 class TestSuite(object):
     def __init__(self, option):
-        self.config = Config()
         self.option = option
+        self.config = Config(source_address=self.source_address, timeout=self.option.args.timeout)
         
     @property
     def client(self):
@@ -1071,7 +3344,20 @@ class TestSuite(object):
     def get_best_server(self):
         def sort_by_latency(servers):
             return sorted(servers, key=lambda server: server.latency)
-        return sort_by_latency(self.servers.get_closest_servers())[0]
+        if self.option.args.server_cache:
+            server = self.server_memory.recall(self)
+            if server is not None:
+                return server
+        candidates = self.servers.get_closest_servers()
+        server = sort_by_latency(candidates)[0]
+        if self.option.args.server_cache:
+            self.server_memory.record(self, server, candidates)
+        return server
+    
+    @property
+    @memoized
+    def server_memory(self):
+        return ServerMemory()
     
     @property
     def ip_version(self):
@@ -1081,6 +3367,29 @@ class TestSuite(object):
             return 'ipv4'
         return 'both'
     
+    @property
+    @memoized
+    def observers(self):
+        return Observers()
+    
+    def observe(self, observer):
+        self.observers.append(observer)
+        return observer
+    
+    @property
+    @memoized
+    def tls_sessions(self):
+        return TLSSessionCache()
+    
+    def start(self, deadline=None, progress=None):
+        return TestRun(self, deadline=deadline, progress=progress)
+    
+    @property
+    def source_address(self):
+        if not self.option.args.source:
+            return None
+        return self.option.args.source[0]
+    
     @property
     @memoized
     def server(self):
@@ -1107,13 +3416,128 @@ class TestSuite(object):
     def results(self):
         return TestSuiteResults(self, self.download, self.upload)
 
+class TestRun(object):
+    # Each stage returns a concurrent.futures.Future; asyncio callers can await asyncio.wrap_future() of it
+    def __init__(self, testsuite, deadline=None, progress=None, interval=0.5):
+        import concurrent.futures
+        self.testsuite = testsuite
+        self.deadline = time.time() + deadline if deadline else None
+        self.futures = []
+        # One thread, so stages run in the order they were asked for and never compete for the link
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='speedtest')
+        # Per run, so cancelling one run leaves the suite and later runs alone
+        self.cancellation = threading.Event()
+        self.observer = testsuite.observe(ProgressCallback(progress, interval)).start() if progress else None
+        self.lock = threading.Lock()
+        self.timer = None
+        self.transfers = {}
+        
+
+    def __repr__(self):
+        return '<TestRun: deadline={},stages={},cancelled={}>'.format(self.deadline, len(self.futures), self.cancelled)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+        
+    def schedule(self, func, *args):
+        with self.lock:
+            future = self.executor.submit(func, *args)
+            self.futures.append(future)
+            # The deadline only needs watching while a stage is pending
+            if self.deadline and self.timer is None:
+                # Only stops the running phase, so results() still builds from what was measured
+                self.timer = threading.Timer(max(self.deadline - time.time(), 0.0), self.cancellation.set)
+                self.timer.daemon = True
+                self.timer.start()
+        future.add_done_callback(self.settle)
+        return future
+    
+    def settle(self, future):
+        with self.lock:
+            if self.timer and all(map(lambda _: _.done(), self.futures)):
+                self.timer.cancel()
+                self.timer = None
+    
+    def length(self, direction):
+        length = self.testsuite.config.params[direction]['length']
+        if self.deadline is None:
+            return length
+        # Leave the transfer phases still queued behind this one their share of the time
+        pending = max(sum(map(lambda _: _ is None or not _.done(), self.transfers.values())), 1)
+        return max(min(length, (self.deadline - time.time()) / pending), 0.1)
+    
+    @memoized
+    def server(self):
+        return self.schedule(lambda: self.testsuite.server)
+    
+    @memoized
+    def download(self):
+        self.server()
+        self.transfers['download'] = self.schedule(lambda: self.testsuite.server.do_download(length=self.length('download'), cancelled=self.cancellation))
+        return self.transfers['download']
+    
+    @memoized
+    def upload(self):
+        self.server()
+        self.transfers['upload'] = self.schedule(lambda: self.testsuite.server.do_upload(length=self.length('upload'), cancelled=self.cancellation))
+        return self.transfers['upload']
+    
+    @memoized
+    def results(self):
+        # Known before either phase starts, so the first one already leaves room for the second
+        self.transfers.setdefault('download', None)
+        self.transfers.setdefault('upload', None)
+        download, upload = self.download(), self.upload()
+        return self.schedule(lambda: TestSuiteResults(self.testsuite, download.result(), upload.result()))
+    
+    @memoized
+    def share(self):
+        results = self.results()
+        return self.schedule(lambda: results.result().speedtestnet)
+    
+    @property
+    def cancelled(self):
+        return self.cancellation.is_set()
+    
+    def cancel(self):
+        # Stages not started yet are dropped; the running transfer phase stops at its next check
+        for future in list(self.futures):
+            future.cancel()
+        self.cancellation.set()
+        
+    def close(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+        if self.observer:
+            self.observer.stop()
+            if self.observer in self.testsuite.observers:
+                self.testsuite.observers.remove(self.observer)
+        self.executor.shutdown(wait=False)
+
 class NullOption(object):
     @dataclasses.dataclass
     class Namespace:
         exclude: list = dataclasses.field(default_factory=list)
+        download: bool = True
+        upload: bool = True
+        source: list = dataclasses.field(default_factory=list)
         pre_allocate: bool = True
+        zero_copy: bool = False
         single: bool = False
+        auto_size: bool = False
+        engine: str = 'http.client'
+        server_cache: bool = True
+        loaded_latency: bool = True
+        protocol: str = 'http'
         timeout: float = 10.0
+        rcvbuf: int = None
+        sndbuf: int = None
+        nodelay: bool = True
         ipv4: bool = True
         ipv6: bool = True
     
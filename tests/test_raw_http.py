@@ -0,0 +1,146 @@
+import http.client
+import http.server
+import threading
+import unittest
+
+import speedtest
+
+class RawHTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        if self.path.startswith('/length'):
+            self.send_response(200)
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            self.wfile.write(b'hello')
+        elif self.path.startswith('/nolength'):
+            # Without Content-Length the body runs until the server closes the connection
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'x' * 100000)
+            self.close_connection = True
+        elif self.path.startswith('/close'):
+            self.send_response(200)
+            self.send_header('Content-Length', '5')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'hello')
+            self.close_connection = True
+        elif self.path.startswith('/truncated'):
+            self.send_response(200)
+            self.send_header('Content-Length', '1000000')
+            self.end_headers()
+            self.wfile.write(b'x' * 400000)
+            self.close_connection = True
+        elif self.path.startswith('/chunked'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'5\r\nhello\r\n0\r\n\r\n')
+        elif self.path.startswith('/status'):
+            self.send_response(int(self.path.rsplit('/', 1)[1]))
+            self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class RawHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RawHTTPHandler)
+        self.clients = set()
+
+class RawHTTPTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = RawHTTPServer()
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self):
+        self.httpd.clients.clear()
+        self.conn = speedtest.RawHTTPConnection('127.0.0.1:%d' % (self.httpd.server_address[1], ), timeout=5.0)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def get(self, path):
+        self.conn.request('GET', path, headers={'Host': '127.0.0.1'})
+        return self.conn.getresponse()
+
+    def test_keepalive(self):
+        for _ in range(3):
+            response = self.get('/length')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader('Content-Length'), '5')
+            self.assertEqual(response.read(), b'hello')
+            self.assertFalse(response.will_close)
+            self.assertIsNotNone(self.conn.sock)
+        # Every request went over the same connection
+        self.assertEqual(len(self.httpd.clients), 1)
+
+    def test_post(self):
+        self.conn.request('POST', '/', body=b'x' * 200000, headers={'Host': '127.0.0.1', 'Content-Length': 200000})
+        self.assertEqual(len(self.conn.getresponse().read()), 200000)
+
+    def test_missing_length(self):
+        response = self.get('/nolength')
+        self.assertTrue(response.will_close)
+        self.assertEqual(len(response.read()), 100000)
+        self.assertIsNone(self.conn.sock)
+
+    def test_no_body(self):
+        for status in (204, 304, ):
+            response = self.get('/status/%d' % (status, ))
+            self.assertEqual(response.status, status)
+            self.assertTrue(response.closed)
+            self.assertEqual(response.read(), b'')
+        self.assertEqual(len(self.httpd.clients), 1)
+
+    def test_connection_close(self):
+        response = self.get('/close')
+        self.assertTrue(response.will_close)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(response.read(), b'hello')
+        self.assertIsNone(self.conn.sock)
+        # The next request reconnects
+        self.assertEqual(self.get('/length').read(), b'hello')
+        self.assertEqual(len(self.httpd.clients), 2)
+
+    def test_truncated(self):
+        response = self.get('/truncated')
+        received = 0
+        buff = memoryview(bytearray(65536))
+        while (n := response.readinto(buff)):
+            received += n
+        # Ends like http.client does, leaving the caller to compare with Content-Length
+        self.assertEqual(received, 400000)
+        self.assertEqual(response.getheader('Content-Length'), '1000000')
+        self.assertIsNone(self.conn.sock)
+
+    def test_chunked(self):
+        with self.assertRaises(http.client.HTTPException):
+            self.get('/chunked')
+
+    def test_response_not_ready(self):
+        self.get('/length')
+        with self.assertRaises(http.client.ResponseNotReady):
+            self.get('/length')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import time
+import socket
+import threading
+import types
+import unittest
+
+import speedtest
+
+class LocalOption(object):
+    def __init__(self, **kwargs):
+        self.args = speedtest.NullOption.Namespace(protocol='tcp', loaded_latency=False, timeout=5.0, **kwargs)
+
+class LocalTestSuite(speedtest.TestSuite):
+    # Skips Config, which would fetch speedtest-config.php
+    def __init__(self, option):
+        self.option = option
+
+class SlowReadHandler(speedtest.TCPProtocolHandler):
+    def upload(self, size, received):
+        while not self.server.stopped.wait(0.1) and self.rfile.read1(64*1024):
+            pass
+
+class SlowReadServer(speedtest.TCPProtocolServer):
+    # Reads upload bodies at about 640kB/s through a small receive buffer, so most of what is sent stays queued on the client
+    def __init__(self):
+        super().__init__()
+        self.RequestHandlerClass = SlowReadHandler
+        self.stopped = threading.Event()
+        
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64*1024)
+        super().server_bind()
+
+class TCPProtocolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tcp = speedtest.TCPProtocolServer().serve()
+        
+    @classmethod
+    def tearDownClass(cls):
+        cls.tcp.shutdown()
+        cls.tcp.server_close()
+        
+    def server(self, **kwargs):
+        testsuite = LocalTestSuite(LocalOption(**kwargs))
+        return speedtest.Server(testsuite, id=1, name='local', url='http://%s/speedtest/upload.php' % (self.tcp.host, ), host=self.tcp.host,
+            country='JP', cc='JP', sponsor='Local', point=speedtest.Point(0.0, 0.0))
+    
+    def test_connection(self):
+        conn = speedtest.TCPConnectionFactory()(speedtest.URL('tcp://' + self.tcp.host))
+        conn.connect()
+        try:
+            self.assertTrue(conn.hello.startswith('HELLO'))
+            self.assertLess(conn.ping(), 1.0)
+            self.assertEqual(conn.download(1000)[0], 1000)
+            self.assertEqual(conn.upload(100000)[0], 100000)
+            # The connection stays usable after each command
+            self.assertEqual(conn.download(10)[0], 10)
+        finally:
+            conn.close()
+            
+    def test_latency(self):
+        server = self.server()
+        latencies = server.measure_tcp_latency(count=3)
+        self.assertEqual(len(latencies), 3)
+        self.assertTrue(all(latency < 1.0 for latency in latencies))
+        self.assertFalse(server.breaker.open)
+        
+    def test_download(self):
+        results = self.server().do_download(threads=2, length=10.0, sizes=[1000000] * 4)
+        self.assertEqual(results.total_size, 4000000)
+        self.assertEqual(results.count, 4)
+        self.assertEqual(results.errors, 0)
+        self.assertEqual(results.partials, 0)
+        
+    def test_upload(self):
+        results = self.server().do_upload(threads=2, length=10.0, sizes=[1000000] * 4)
+        self.assertEqual(results.total_size, 4000000)
+        self.assertEqual(results.count, 4)
+        self.assertEqual(results.errors, 0)
+        self.assertEqual(results.partials, 0)
+        
+    def test_download_cancelled(self):
+        size = 1 << 40
+        start = time.time()
+        results = self.server().do_download(threads=1, length=0.3, sizes=[size])
+        self.assertLess(time.time() - start, 3.0)
+        self.assertEqual(results.partials, 1)
+        self.assertEqual(results.errors, 0)
+        self.assertTrue(0 < results.total_size < size)
+        
+    def test_upload_cancelled(self):
+        size = 1 << 40
+        start = time.time()
+        results = self.server().do_upload(threads=1, length=0.3, sizes=[size])
+        self.assertLess(time.time() - start, 3.0)
+        self.assertEqual(results.partials, 1)
+        self.assertEqual(results.errors, 0)
+        self.assertTrue(0 < results.total_size < size)
+        
+    def test_upload_cancelled_unacknowledged(self):
+        slow = SlowReadServer().serve()
+        try:
+            testsuite = LocalTestSuite(LocalOption())
+            server = speedtest.Server(testsuite, id=2, name='slow', url='http://%s/speedtest/upload.php' % (slow.host, ), host=slow.host,
+                country='JP', cc='JP', sponsor='Local', point=speedtest.Point(0.0, 0.0))
+            results = server.do_upload(threads=1, length=0.5, sizes=[64*1024*1024])
+        finally:
+            slow.stopped.set()
+            slow.shutdown()
+            slow.server_close()
+        self.assertEqual(results.partials, 1)
+        # Only what the server acknowledged counts, not what sat in the client's send buffer
+        self.assertLess(results.total_size, 1024*1024)
+        
+    def test_run_cancelled(self):
+        server = self.server()
+        cancelled = threading.Event()
+        cancelled.set()
+        results = server.do_download(threads=2, length=10.0, sizes=[1 << 40] * 2, cancelled=cancelled)
+        self.assertEqual(results.errors, 0)
+        self.assertLess(results.total_size, 2 << 40)
+        # The event belongs to the caller; later phases on the same server are unaffected
+        results = server.do_download(threads=1, length=10.0, sizes=[1000000])
+        self.assertEqual(results.total_size, 1000000)
+
+    def test_run_deadline(self):
+        server = self.server()
+        testsuite = server.testsuite
+        testsuite._memoized_server = server
+        testsuite.config = types.SimpleNamespace(params={direction: {'length': 10.0, 'sizes': [1 << 40], 'counts': 1} for direction in ('download', 'upload', )})
+        progress = []
+        start = time.time()
+        with speedtest.TestRun(testsuite, deadline=2.0, progress=lambda *args: progress.append(args), interval=0.1) as run:
+            results = run.results().result(timeout=10.0)
+        # Both phases share the deadline, and the results stage still builds from them
+        self.assertLess(time.time() - start, 4.0)
+        self.assertGreater(results.download.total_size, 0)
+        self.assertGreater(results.upload.total_size, 0)
+        # Reported from the timer thread while running, then the final total at each phase end
+        self.assertGreater(len(progress), 2)
+        self.assertIn(('download', results.download.total_size, ), progress)
+        self.assertEqual(progress[-1], ('upload', results.upload.total_size, ))
+
+if __name__ == '__main__':
+    unittest.main()